@@ -1,18 +1,29 @@
 import sys
 import os
-import shutil
 
 
-from typing import Any, Dict, Sequence
+from typing import Any, Dict, Optional, Sequence
 
 from uniontype import union
 
 from npf_utils import (
 	default_cmdline_options,
+	split_cmdline_args,
 	cmdline_options_to_internal_options,
+	default_socket_path,
 
-	SHOULD_BE_FIXED_props,
+	IS_SUBTITLE_FILE,
+	get_HAS_ACCOMPANYING_VIDEO,
 	file_has_properties_detailed,
+	list_dir_files,
+	FileEntry,
+	FileResult,
+	Fixed,
+	NotFixed,
+
+	fix,
+	fix_unsafe,
+	file_contents,
 
 	indent,
 	impossible,
@@ -32,103 +43,268 @@ from npf_utils import (
 
 
 
+from npf_dedup import DedupIndex, hardlink_to
+from npf_pipeline import run_pipeline
+from npf_batch import audit_files
+from npf_incremental import process_growing_file
+from npf_undo import UndoJournal, backup_file, backup_and_write_fixed, write_backed_up_fixed, undo_run
+from npf_schedule import order_entries, with_read_ahead, benchmark_io_orders
+from npf_progress import Progress
+from npf_episodes import VideoIndex
+from npf_server import serve
+from npf_adaptive import AdaptiveDetector
+from npf_convert import convert_files
+from npf_videohash import pair_videos
+from npf_shard import entries_in_shard, FileLease
+from npf_checkpoint import RunJournal, run_key, recover
 
-def fix_unsafe(text: str) -> str:
-	return text.encode('windows-1252').decode('windows-1250')
-
-def fix(text: str) -> str:
-	return text \
-			.encode('windows-1252', errors='replace') \
-			.decode('windows-1250', errors='replace')
 
 
 
 
-
-def main():
+def main() -> IO_[int]:
+	""" Returns the exit status: 0 - OK, 1 - something failed, 2 - invalid arguments """
 	args = sys.argv[1:]
 	print("args: " + str.join(' ', args))
 
-	cmdline_options = default_cmdline_options
-
-	mode    = cmd_args_to_mode(args)
-	options = cmdline_options_to_internal_options(cmdline_options)
+	try:
+		switches, positional_args = split_cmdline_args(args)
+		options = cmdline_options_to_internal_options(dict(default_cmdline_options, **switches))
+	except ValueError as err:
+		mode = Mode.InvalidArgs("Error: " + str(err))
+		options = cmdline_options_to_internal_options(default_cmdline_options)
+	else:
+		mode = cmd_args_to_mode(positional_args, switches)
 
 	print("Working in directory " + os.getcwd())
 	print("Mode: " + mode.get_variant_name())
 
+	if options['backup'] and options['backup_method'] == 'journal':
+		options['undo_journal'] = UndoJournal(options['undo_journal_root'])
+
+	try:
+		status = run_mode(mode, options)
+	finally:
+		journal = options['undo_journal']
+		if journal is not None and journal.n_records > 0:
+			journal.close()
+			print()
+			print("Undo journal: {} files (undo with --undo {})".format(journal.n_records, journal.run_id))
+	return status
+
+
+
+def run_mode(mode: 'Mode', options: Dict[str, Any]) -> IO_[int]:
+	""" Returns the exit status, see `main` """
 	if mode.is_SingleFile():
 		filename = mode.filename
 		print("Selected file: " + filename)
+		if options['require_video']:
+			# the video is usually next to the subtitle, or one directory up ('Subs/')
+			own_dir = os.path.dirname(os.path.abspath(filename))
+			require_video(list_dir_files(own_dir, False) + list_dir_files(os.path.dirname(own_dir), False), options)
 		print()
 
-		# ****************************
-		process_file(filename, options)
-		# ****************************
+		if options['audit']:
+			audit_files([filename], options)
+		elif options['to_srt']:
+			convert_files([filename], options)
+		elif options['incremental']:
+			process_growing_file(filename, options)
+		else:
+			# ****************************
+			process_file(filename, options)
+			# ****************************
 
 	elif mode.is_SingleDir():
 		dirname = mode.dirname
 		print("Selected dir: " + dirname)
-		dir_item_names = (os.path.join(dirname, name) for name in os.listdir(dirname))
-		dir_files = [name for name in dir_item_names if os.path.isfile(name)]
+		dir_files = order_entries(list_dir_files(dirname, options['recursive']), options['io_order'])
+		if options['require_video']:
+			# from the whole listing - a subtitle's video may be in another shard.
+			# And from the dir above, like for a single file ('Show/Subs')
+			parent_dir = os.path.dirname(os.path.abspath(dirname))
+			parent_files = list_dir_files(parent_dir, False) if parent_dir != os.path.abspath(dirname) else []
+			require_video(dir_files + parent_files, options)
+
+		if options['shard'] is not None:
+			n_all_files = len(dir_files)
+			dir_files = entries_in_shard(dir_files, dirname, options['shard'])
+			print("Shard {}/{}: {} of {} files".format(*options['shard'], len(dir_files), n_all_files))
 
 		if len(dir_files) == 0:
 			print()
 			print("Dir is empty.")
-		else:
+		elif options['benchmark_io']:
+			print()
+			benchmark_io_orders(dir_files, options)
+		elif options['audit']:
+			print()
+			audit_files([entry.path for entry in dir_files], options)
+		elif options['to_srt']:
+			print()
+			convert_files([entry.path for entry in dir_files], options)
+		elif options['pair_videos']:
 			print()
-			for filename in dir_files:
-				# ****************************
-				process_file(filename, options)
-				# ****************************
+			pair_videos(dir_files, options)
+		elif options['incremental']:
+			print()
+			for entry in dir_files:
+				process_growing_file(entry.path, options)
 				print()
+		elif options['workers'] > 1:
+			if options['dedup']:
+				print("Note: --dedup is not supported with --workers, ignoring it.")
+			if options['adaptive']:
+				print("Note: --adaptive is not supported with --workers, ignoring it.")
+			if options['shard'] is not None:
+				print("Note: files are not leased with --workers, run one process per shard instead.")
+			if options['checkpoint']:
+				# --resume needs --checkpoint, so that's both of them
+				print("Note: --checkpoint and --resume are not supported with --workers, ignoring them.")
+			print()
+			if run_pipeline(dir_files, options) > 0:
+				return 1
+		else:
+			run_journal = None
+			if options['checkpoint']:
+				journal_path = os.path.join(options['runs_dir'], run_key(dirname, options) + '.journal')
+				run_journal = RunJournal(journal_path, options['resume'])
+				if options['resume']:
+					print()
+					dir_files = recover(dir_files, journal_path, run_journal)
+				options['run_journal'] = run_journal
+
+			dedup = None
+			if options['dedup']:
+				dedup = DedupIndex(dir_files)
+				print("Files with identical contents: {} (duplicates: {})" \
+					  .format(len(dedup.digests), dedup.n_duplicates))
+
+			adaptive = None
+			if options['adaptive']:
+				adaptive = AdaptiveDetector(options['verify'])
+				options['should_be_fixed_props'] = [IS_SUBTITLE_FILE, adaptive.file_prop()]
+				options['adaptive_detector'] = adaptive
+
+			progress = Progress(dir_files) if options['progress'] else None
+			if progress is not None:
+				counters = progress.new_counters()
+				progress.start()
+
+			print()
+			try:
+				for entry in with_read_ahead(dir_files, options):
+					# ****************************
+					if options['shard'] is None:
+						result = process_file(entry.path, options, dedup)
+					else:
+						result = process_leased_file(entry.path, options, dedup)
+					# ****************************
+					print()
+					if run_journal is not None:
+						run_journal.commit(entry.path, result)
+					if progress is not None:
+						counters.file_done(entry.size, result)
+				if run_journal is not None:
+					run_journal.finish()
+			finally:
+				if progress is not None:
+					progress.stop()
+				if run_journal is not None:
+					run_journal.close()
+
+			if adaptive is not None:
+				adaptive.print_stats()
+
+	elif mode.is_Undo():
+		run_id = mode.run_id
+		print("Undoing run: " + run_id)
+		print()
+		if not undo_run(run_id, options['undo_journal_root']):
+			return 1
+
+	elif mode.is_Serve():
+		print("Serving on " + mode.socket_path)
+		if options['require_video']:
+			print("Note: --require-video is not supported with --serve, ignoring it.")
+		print()
+		serve(mode.socket_path, options)
 
 	elif mode.is_InvalidArgs():
 		error = mode.error
 		print()		
 		print(error)
+		return 2
 
 	elif mode.is_NPFError():
 		error = mode.err
 		print()		
 		print(error)
+		return 1
 
 	else:
 		impossible("Unrecognized mode: " + str(mode))
 
+	return 0
+
 
 
 
 
 
-def process_file(filename: str, options: Dict[str, Any]) -> IO_[None]:
+def require_video(entries: Sequence[FileEntry], options: Dict[str, Any]) -> IO_[None]:
+	video_index = VideoIndex.from_entries(entries)
+	print("Videos found: {}".format(video_index.n_videos))
+	options['extra_file_props'].append(get_HAS_ACCOMPANYING_VIDEO(video_index))
+
+
+
+def process_file(filename: str, options: Dict[str, Any], dedup: Optional[DedupIndex] = None) -> IO_[FileResult]:
+	props = options['should_be_fixed_props'] + options['extra_file_props']
+	if dedup is not None:
+		props = dedup.memoized_props(props)
 	should_fix_file, reasons = file_has_properties_detailed(
-							   		filename,  SHOULD_BE_FIXED_props,
+							   		filename,  props,
 									options['show_file_processing_reasons'])
 	print(filename)
 	print(str.join('\n', map(lambda s: indent(s, 4),  reasons) ))
+	# already read whole by adaptive detection
+	o_text = options['adaptive_detector'].take_text(filename) if options['adaptive_detector'] is not None else None
+
+	if dedup is not None:
+		original = dedup.original_of(filename)
+		if original is not None:
+			print(indent("has the same contents as " + original, 4))
 
 	if should_fix_file:
 		print("Fixing " + filename)
 
-		if options['backup']:
-			shutil.copy(filename, filename+'.bak')
-
-
 		# ****************************
-		file = open(filename, mode='r+', encoding='utf-8-sig')
-
-		text = file.read()
-
-
-		fixed = fix(text)
-
-
-		file.seek(0)
-		n_bytes = file.write(fixed)
-		file.close()
+		if dedup is None:
+			fixed = fix(o_text if o_text is not None else file_contents(filename))
+		else:
+			fixed = dedup.fixed_text(filename)
+
+		fixed_copy = dedup.fixed_copy_of(filename) if dedup is not None else None
+
+		if fixed_copy is not None and options['hardlink_duplicates']:
+			as_new_file = backup_file(filename, fixed, options, new_file=True)
+			try:
+				hardlink_to(fixed_copy, filename)
+				n_bytes = len(fixed)
+			except OSError as err:  # e.g. EXDEV - the copy is on another filesystem
+				print(indent("can't hard link to {} ({}), writing it instead".format(fixed_copy, err.strerror), 4))
+				n_bytes = write_backed_up_fixed(filename, fixed, as_new_file)
+		elif options['run_journal'] is not None:
+			n_bytes = options['run_journal'].backup_and_write_fixed(filename, fixed, options)
+		else:
+			n_bytes = backup_and_write_fixed(filename, fixed, options)
 		# ****************************
 
+		if dedup is not None:
+			dedup.mark_fixed(filename)
+
 
 		if n_bytes > 0:
 			print('Success')
@@ -137,9 +313,33 @@ def process_file(filename: str, options: Dict[str, Any]) -> IO_[None]:
 		else:
 			print('Error: could not write to file')
 
+		result = Fixed(filename, n_bytes)
+
 	else:
 		print("Not fixing.")
 		# print("Done.")
+		result = NotFixed(filename)
+
+	if dedup is not None:
+		dedup.done(filename)
+
+	return result
+
+
+
+
+def process_leased_file(filename: str, options: Dict[str, Any], dedup: Optional[DedupIndex] = None) -> IO_[FileResult]:
+	# another node may be working on it, if runs overlap
+	with FileLease(filename, options['lease_ttl']) as lease:
+		acquired = lease.acquired
+		if acquired and os.path.exists(filename):
+			return process_file(filename, options, dedup)
+	print(filename)
+	if acquired:
+		print(indent("removed by another node, skipping", 4))
+	else:
+		print(indent("leased by another node, skipping", 4))
+	return NotFixed(filename)
 
 
 
@@ -147,19 +347,33 @@ def process_file(filename: str, options: Dict[str, Any]) -> IO_[None]:
 Mode, \
 	SingleFile, \
 	SingleDir,  \
+	Undo, \
+	Serve, \
 	InvalidArgs, \
 	NPFError,  \
 = union(
 	'Mode', [
 		('SingleFile', [('filename', str)]),
 		('SingleDir',  [('dirname', str)]),
+		('Undo',       [('run_id', str)]),
+		('Serve',      [('socket_path', str)]),
 		('InvalidArgs', [('error', str)]),
 		('NPFError',    [('err', str)]),
 	]
   )
 
-def cmd_args_to_mode(args: Sequence[str]) -> Mode:
-	if len(args) == 0:
+def cmd_args_to_mode(args: Sequence[str], switches: Dict[str, Any]) -> Mode:
+	if 'undo' in switches:
+		if len(args) == 0:
+			mode = Mode.Undo(switches['undo'])
+		else:
+			mode = Mode.InvalidArgs("Error: --undo doesn't take files: " + str.join(' ', args))
+	elif switches.get('serve', False):
+		if len(args) == 0:
+			mode = Mode.Serve(switches.get('socket', default_socket_path))
+		else:
+			mode = Mode.InvalidArgs("Error: --serve doesn't take files: " + str.join(' ', args))
+	elif len(args) == 0:
 		mode = Mode.SingleDir( os.getcwd() )
 	elif len(args) == 1:
 		arg = args[0]
@@ -184,5 +398,5 @@ def cmd_args_to_mode(args: Sequence[str]) -> Mode:
 
 
 if __name__ == '__main__':
-	main()
+	sys.exit(main())
 	
\ No newline at end of file
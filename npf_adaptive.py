@@ -0,0 +1,150 @@
+import os
+import codecs
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from npf_utils import (
+	FileProperty,
+	IS_SUBTITLE_FILE,
+	IS_MISDECODED_POLISH_FILE,
+	IS_MISDECODED_POLISH_TEXT,
+	misdecoded_polish_chars_no_dup,
+	polish_chars_no_dup,
+	any_in,
+	file_contents,
+	indent,
+	IO_,
+)
+
+
+# === Adaptive, per-directory detection ===
+
+# The files of one release folder are nearly always all misdecoded or all
+# fine. The first few files of each directory are checked in full, and if
+# they agree, that's the directory's prior.
+#
+# In a misdecoded directory, files are still checked in full: they're going
+# to be fixed, so they're read whole anyway, and `fix` would turn any polish
+# text past a sample into '?'. The text is kept for the fix (`take_text`),
+# so a fixed file is read once.
+#
+# In a fine directory, only the first SAMPLE_BYTES of a file are checked:
+#
+#   the sample has polish characters      -> not misdecoded. Exact, the full check would say the same.
+#   the sample is the whole file          -> the sample's verdict. Exact.
+#   no misdecoded characters              -> not misdecoded.
+#   misdecoded characters in the sample   -> a full check.
+#
+# So the sample only ever decides that a file is *not* misdecoded - a file is
+# never fixed without a full check. A full check that contradicts the prior
+# drops it, and the rest of the directory is checked in full.
+#
+# `--verify` also checks every file in full, uses that verdict, and reports
+# the files where the adaptive verdict would have been different.
+
+PRIOR_FILES = 3
+SAMPLE_BYTES = 16 * 1024
+
+# how a verdict was reached
+FULL, EXACT_SAMPLE, SAMPLED, CONFIRMED, ESCALATED = 'full', 'exact sample', 'sampled', 'confirmed', 'escalated'
+
+
+def read_sample(filename: str, n_bytes: int) -> IO_[Tuple[str, bool]]:
+	""" (the first `n_bytes` of the file as text, whether that's the whole file) """
+	with open(filename, mode='rb') as file:
+		data = file.read(n_bytes + 1)
+	is_whole_file = len(data) <= n_bytes
+	# a character cut in half at the end of the sample is dropped, not an error
+	decoder = codecs.getincrementaldecoder('utf-8-sig')()
+	return (decoder.decode(data[:n_bytes], final=is_whole_file), is_whole_file)
+
+
+
+class AdaptiveDetector:
+
+	def __init__(self, verify: bool = False):
+		self.verify = verify
+		self.full_verdicts = defaultdict(list)  # type: Dict[str, List[bool]]
+		self.prior = {}                         # type: Dict[str, Optional[bool]]  (None - mixed directory)
+		self.n_by_method = defaultdict(int)     # type: Dict[str, int]
+		self.disagreements = []                 # type: List[Tuple[str, bool, bool]]
+		self.texts = {}                         # type: Dict[str, str]  (misdecoded files, until they're fixed)
+
+
+	def is_misdecoded_polish_file(self, filename: str) -> IO_[bool]:
+		if not IS_SUBTITLE_FILE.pred(filename):
+			return False  # won't be fixed anyway. Not read, and doesn't count towards the prior
+		verdict, method = self._adaptive_verdict(filename)
+		self.n_by_method[method] += 1
+		if self.verify:
+			full_verdict = verdict if method != SAMPLED \
+						   else IS_MISDECODED_POLISH_FILE.pred(filename)
+			if full_verdict != verdict:
+				self.disagreements.append((filename, verdict, full_verdict))
+			return full_verdict
+		return verdict
+
+	def take_text(self, filename: str) -> Optional[str]:
+		""" the text of a file found misdecoded, if it was read whole. Call once the file has been classified. """
+		return self.texts.pop(filename, None)
+
+	def file_prop(self) -> FileProperty:
+		""" a drop-in replacement for IS_MISDECODED_POLISH_FILE """
+		return FileProperty(IS_MISDECODED_POLISH_FILE.true_text,
+							IS_MISDECODED_POLISH_FILE.false_text,
+							self.is_misdecoded_polish_file)
+
+
+	def _adaptive_verdict(self, filename: str) -> IO_[Tuple[bool, str]]:
+		dirname = os.path.dirname(os.path.abspath(filename))
+		prior = self.prior.get(dirname)
+		if prior is None:
+			# still learning, or a mixed directory
+			return (self._check_text(dirname, filename, file_contents(filename)), FULL)
+		if prior:
+			verdict = self._check_text(dirname, filename, file_contents(filename))
+			return (verdict, CONFIRMED if verdict else ESCALATED)
+
+		sample, is_whole_file = read_sample(filename, SAMPLE_BYTES)
+		if any_in(sample, polish_chars_no_dup):
+			return (False, EXACT_SAMPLE)
+		if is_whole_file:
+			# not kept for the fix - `file_contents` reads it with newlines translated
+			verdict = IS_MISDECODED_POLISH_TEXT.pred(sample)
+			self._learn(dirname, verdict)
+			return (verdict, EXACT_SAMPLE)
+		if not any_in(sample, misdecoded_polish_chars_no_dup):
+			return (False, SAMPLED)
+
+		# the sample disagrees with the prior - check it all
+		return (self._check_text(dirname, filename, file_contents(filename)), ESCALATED)
+
+	def _check_text(self, dirname: str, filename: str, text: str) -> bool:
+		""" the verdict for the file's whole `text` (from `file_contents`), learned from """
+		verdict = IS_MISDECODED_POLISH_TEXT.pred(text)
+		self._learn(dirname, verdict)
+		if verdict:
+			self.texts[filename] = text
+		return verdict
+
+
+	def _learn(self, dirname: str, verdict: bool) -> None:
+		verdicts = self.full_verdicts[dirname]
+		verdicts.append(verdict)
+		if dirname not in self.prior and len(verdicts) < PRIOR_FILES:
+			return
+		if all(v == verdicts[0] for v in verdicts):
+			self.prior[dirname] = verdicts[0]
+		else:
+			self.prior[dirname] = None  # for good - a prior that was wrong once isn't trusted again
+
+
+	def print_stats(self) -> IO_[None]:
+		n_files = sum(self.n_by_method.values())
+		print("Adaptive detection: {} files".format(n_files))
+		for method in (FULL, EXACT_SAMPLE, SAMPLED, CONFIRMED, ESCALATED):
+			print(indent("{:13} {}".format(method + ':', self.n_by_method[method]), 4))
+		if self.verify:
+			print("Verified in full: {} disagreements".format(len(self.disagreements)))
+			for (filename, verdict, full_verdict) in self.disagreements:
+				print(indent("{}: adaptive {}, full {}".format(filename, verdict, full_verdict), 4))
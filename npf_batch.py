@@ -0,0 +1,124 @@
+from collections import namedtuple
+from typing import Any, Dict, List, Sequence
+
+try:
+	import numpy as np
+except ImportError:  # numpy is optional, only needed for engine='numpy'
+	np = None
+
+from npf_utils import (
+	IS_SUBTITLE_FILE,
+	misdecoded_polish_chars_no_dup,
+	polish_chars_no_dup,
+	indent,
+	IO_,
+)
+
+
+# === Batch detection ===
+
+# Classifies many texts at once with the same verdict as IS_MISDECODED_POLISH_TEXT:
+#   misdecoded  <=>  some char from misdecoded_polish_chars_no_dup
+#                    and no char from polish_chars_no_dup
+# and also returns how many chars of each kind every text has.
+
+BatchVerdicts = namedtuple('BatchVerdicts', ['verdicts', 'misdecoded_counts', 'polish_counts'])
+
+
+def classify_texts(texts: Sequence[str], engine: str) -> BatchVerdicts:
+	if engine == 'numpy':
+		return classify_texts_numpy(texts)
+	elif engine == 'python':
+		return classify_texts_python(texts)
+	else:
+		raise ValueError("Unknown detection engine: " + engine)
+
+
+def classify_texts_python(texts: Sequence[str]) -> BatchVerdicts:
+	misdecoded_counts = [ sum(1 for ch in text if ch in misdecoded_polish_chars_no_dup) for text in texts ]
+	polish_counts     = [ sum(1 for ch in text if ch in polish_chars_no_dup)            for text in texts ]
+	verdicts = [ n_misdecoded > 0 and n_polish == 0
+				 for (n_misdecoded, n_polish) in zip(misdecoded_counts, polish_counts) ]
+	return BatchVerdicts(verdicts, misdecoded_counts, polish_counts)
+
+
+
+NEITHER, MISDECODED, POLISH = 0, 1, 2
+
+_char_class_table = None
+
+def char_class_table() -> 'np.ndarray':
+	"""
+	codepoint -> NEITHER | MISDECODED | POLISH.
+	The last entry is NEITHER, codepoints past the end are clipped to it.
+	"""
+	global _char_class_table
+	if _char_class_table is None:
+		all_chars = misdecoded_polish_chars_no_dup | polish_chars_no_dup
+		table = np.zeros(max(map(ord, all_chars)) + 2, dtype=np.uint8)
+		table[ [ord(ch) for ch in misdecoded_polish_chars_no_dup] ] = MISDECODED
+		table[ [ord(ch) for ch in polish_chars_no_dup]            ] = POLISH
+		_char_class_table = table
+	return _char_class_table
+
+
+def classify_texts_numpy(texts: Sequence[str]) -> BatchVerdicts:
+	if np is None:
+		raise ImportError("The 'numpy' detection engine needs numpy installed")
+
+	n_texts = len(texts)
+	table = char_class_table()
+
+	# one UTF-32 array for the whole batch, and the index of the text each codepoint came from
+	codepoints = np.frombuffer(str.join('', texts).encode('utf-32-le'), dtype='<u4')
+	lengths    = np.fromiter(map(len, texts), dtype=np.int64, count=n_texts)
+	text_ids   = np.repeat(np.arange(n_texts), lengths)
+
+	classes = table[ np.minimum(codepoints, len(table) - 1) ]
+
+	misdecoded_counts = np.bincount(text_ids[classes == MISDECODED], minlength=n_texts)
+	polish_counts     = np.bincount(text_ids[classes == POLISH],     minlength=n_texts)
+	verdicts = (misdecoded_counts > 0) & (polish_counts == 0)
+
+	return BatchVerdicts(verdicts.tolist(), misdecoded_counts.tolist(), polish_counts.tolist())
+
+
+
+# === Audit ===
+
+def audit_files(filenames: Sequence[str], options: Dict[str, Any]) -> IO_[List[str]]:
+	"""
+	Lists the misdecoded subtitle files in `filenames` without fixing anything,
+	reading and classifying them `options['batch_size']` files at a time.
+	"""
+	engine = options['detect_engine']
+	batch_size = options['batch_size']
+	subtitle_files = [filename for filename in filenames if IS_SUBTITLE_FILE.pred(filename)]
+
+	misdecoded_files = []
+	n_unreadable = 0
+	for batch_start in range(0, len(subtitle_files), batch_size):
+		batch = subtitle_files[batch_start : batch_start+batch_size]
+
+		read_filenames, texts = [], []
+		for filename in batch:
+			try:
+				with open(filename, mode='rb') as file:
+					texts.append(file.read().decode('utf-8-sig'))
+				read_filenames.append(filename)
+			except (OSError, UnicodeDecodeError) as err:
+				n_unreadable += 1
+				print(filename)
+				print(indent("Error: " + str(err), 4))
+
+		result = classify_texts(texts, engine)
+		for (filename, is_misdecoded, n_misdecoded) in zip(read_filenames, result.verdicts, result.misdecoded_counts):
+			if is_misdecoded:
+				misdecoded_files.append(filename)
+				print(filename)
+				print(indent("is a misdecoded polish file ({} misdecoded chars)".format(n_misdecoded), 4))
+
+	print()
+	print("Audited {} subtitle files ({} engine): {} misdecoded, {} unreadable" \
+		  .format(len(subtitle_files), engine, len(misdecoded_files), n_unreadable))
+	return misdecoded_files
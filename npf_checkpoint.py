@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import hashlib
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from npf_utils import (
+	FileEntry,
+	FileResult,
+	Fixed,
+	NotFixed,
+	indent,
+	IO_,
+)
+from npf_undo import (
+	TMP_SUFFIX,
+	sha1,
+	fixed_file_bytes,
+	backup_file,
+	write_new_file,
+)
+
+
+# === Checkpoints: resuming an interrupted run ===
+
+# Every directory run keeps a journal in  ~/.npf/runs/<run key>.journal,
+# one JSON line per state change of a file:
+#
+#   claimed    about to be fixed - with the sha1 of the original and of the fixed contents
+#   backed_up  the backup is done (and on the disk)
+#   written    the fixed contents replaced the file
+#   committed  done with the file, fixed or not - with its size and mtime then
+#
+# Fixed files are replaced atomically (a new file, renamed over the old one),
+# so after a crash a file has either its original or its fixed contents.
+# That's also why checkpoints are opt-in (`--checkpoint`): the new file is
+# a regular file owned by whoever runs npf, so a symlink gets replaced
+# instead of its target being fixed, a hard link to the file is left
+# with the old contents, and the owner, ACLs and xattrs are lost.
+# Records are flushed in batches, except that a `claimed` record is on the
+# disk before its file is touched - so any file that may have been changed
+# has a record saying what it was and what it was going to be.
+#
+# `--resume` reads the journal of the last run on the same dir, skips the
+# committed files without reading them (unless their size or mtime changed
+# since - e.g. a subtitle replaced by a new download), and for the files that
+# were in the middle of being fixed, looks at their contents:
+#   the fixed contents     - the write went through, it's committed
+#   the original contents  - rolled back (a leftover temp file is removed) and processed again
+#   anything else          - changed by someone else since, left alone
+# A fixed file is never fixed again - that would mangle it.
+# If the last run finished, there's nothing to resume - it starts over.
+
+FLUSH_EVERY_RECORDS = 256
+FLUSH_EVERY_SECONDS = 2.0
+
+CLAIMED, BACKED_UP, WRITTEN, COMMITTED = 'claimed', 'backed_up', 'written', 'committed'
+
+
+def run_key(dirname: str, options: Dict[str, Any]) -> str:
+	""" runs over the same files get the same key """
+	what = [os.path.abspath(dirname), options['recursive'], options['shard']]
+	return hashlib.sha1(json.dumps(what).encode('utf-8')).hexdigest()[:16]
+
+
+def file_sha1(filename: str) -> IO_[str]:
+	with open(filename, mode='rb') as file:
+		return sha1(file.read())
+
+
+def stat_key(filename: str) -> IO_[Optional[List[int]]]:
+	""" [size, mtime_ns], None if the file is gone """
+	try:
+		st = os.stat(filename)
+	except FileNotFoundError:
+		return None
+	return [st.st_size, st.st_mtime_ns]
+
+
+
+class RunJournal:
+
+	def __init__(self, path: str, resume: bool):
+		self.path = path
+		self.pending = []  # type: List[bytes]
+		self.last_flush = time.monotonic()
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.file = open(path, mode='ab' if resume else 'wb')
+
+
+	def _append(self, record: Dict[str, Any], sync: bool = False) -> IO_[None]:
+		self.pending.append(json.dumps(record).encode('utf-8') + b'\n')
+		if sync or len(self.pending) >= FLUSH_EVERY_RECORDS \
+				or time.monotonic() - self.last_flush >= FLUSH_EVERY_SECONDS:
+			self.flush(sync)
+
+	def flush(self, sync: bool = False) -> IO_[None]:
+		if len(self.pending) > 0:
+			self.file.write(b''.join(self.pending))
+			self.pending = []
+			self.file.flush()
+		if sync:
+			os.fsync(self.file.fileno())
+		self.last_flush = time.monotonic()
+
+	def close(self) -> IO_[None]:
+		self.flush(sync=True)
+		self.file.close()
+
+
+	def claim(self, filename: str, original_sha1: str, fixed_sha1: str) -> IO_[None]:
+		record = {'state': CLAIMED, 'path': os.path.abspath(filename),
+				  'original_sha1': original_sha1, 'fixed_sha1': fixed_sha1}
+		self._append(record, sync=True)
+
+	def mark(self, filename: str, state: str) -> IO_[None]:
+		self._append({'state': state, 'path': os.path.abspath(filename)})
+
+	def commit(self, filename: str, result: FileResult) -> IO_[None]:
+		self._append({'state': COMMITTED, 'path': os.path.abspath(filename), 'result': result.get_variant_name(),
+					  'stat': stat_key(filename)})
+
+	def finish(self) -> IO_[None]:
+		self._append({'state': 'finished'}, sync=True)
+
+
+	def backup_and_write_fixed(self, filename: str, fixed: str, options: Dict[str, Any]) -> IO_[int]:
+		""" `npf_undo.backup_and_write_fixed`, with each step in the journal """
+		with open(filename, mode='rb') as file:
+			original = file.read()
+		written = fixed_file_bytes(fixed)
+		self.claim(filename, sha1(original), sha1(written))
+
+		backup_file(filename, fixed, options, new_file=True)
+		if options['undo_journal'] is not None:
+			options['undo_journal'].sync()
+		self.mark(filename, BACKED_UP)
+
+		write_new_file(filename, written, durable=True)
+		self.mark(filename, WRITTEN)
+		return len(fixed)
+
+
+
+def read_run_journal(path: str) -> IO_[Iterator[Dict[str, Any]]]:
+	with open(path, mode='rb') as file:
+		for line in file:
+			if not line.endswith(b'\n'):
+				return  # cut short by a crash
+			yield json.loads(line.decode('utf-8'))
+
+
+def last_states(path: str) -> IO_[Tuple[Dict[str, Dict[str, Any]], bool]]:
+	"""
+	(path -> the `claimed` record of a file that wasn't committed, or a `committed` record;
+	 whether the run finished)
+	Only the records of the last run count - a run started over after a finished one
+	appends to the same journal.
+	"""
+	states = {}
+	finished = False
+	for record in read_run_journal(path):
+		if record['state'] == 'finished':
+			finished = True
+			continue
+		if finished:
+			states = {}
+			finished = False
+		if record['state'] in (CLAIMED, COMMITTED):
+			states[record['path']] = record
+		# backed_up / written - the claim has all that's needed to recover
+	return (states, finished)
+
+
+
+def recover(entries: Sequence[FileEntry], journal_path: str, journal: RunJournal) -> IO_[List[FileEntry]]:
+	"""
+	Finishes or rolls back the files the last run was in the middle of.
+	Returns the entries that still have to be processed.
+	"""
+	if not os.path.exists(journal_path):
+		print("Nothing to resume, starting from the beginning.")
+		return list(entries)
+
+	states, finished = last_states(journal_path)
+	if finished:
+		print("The last run on this dir finished, starting from the beginning.")
+		return list(entries)
+
+	remaining = []
+	n_committed = 0
+	for entry in entries:
+		record = states.get(os.path.abspath(entry.path))
+		if entry.path.endswith(TMP_SUFFIX):
+			continue  # a write cut short - removed below, if it's from this run
+		elif record is None:
+			remaining.append(entry)
+		elif record['state'] == COMMITTED:
+			if record.get('stat') == stat_key(entry.path):
+				n_committed += 1
+			else:
+				remaining.append(entry)  # changed since it was done
+		elif _recover_claimed(entry.path, record, journal):
+			n_committed += 1
+		else:
+			remaining.append(entry)
+
+	print("Resuming: {} files done before, {} to go".format(n_committed, len(remaining)))
+	return remaining
+
+
+def _recover_claimed(filename: str, claim: Dict[str, Any], journal: RunJournal) -> IO_[bool]:
+	""" True if the file is done, False if it should be processed again """
+	tmp_filename = filename + TMP_SUFFIX
+	if os.path.exists(tmp_filename):
+		os.remove(tmp_filename)  # a write that didn't get to replace the file
+
+	current_sha1 = file_sha1(filename)
+	print(filename)
+	if current_sha1 == claim['fixed_sha1']:
+		print(indent("was fixed, but not committed - committing", 4))
+		journal.commit(filename, Fixed(filename, os.path.getsize(filename)))
+		return True
+	elif current_sha1 == claim['original_sha1']:
+		print(indent("was being fixed - rolled back, fixing again", 4))
+		return False
+	else:
+		print(indent("was being fixed, but has changed since - leaving it alone", 4))
+		journal.commit(filename, NotFixed(filename))
+		return True
@@ -0,0 +1,197 @@
+import os
+import re
+from collections import namedtuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+	import numpy as np
+except ImportError:  # numpy is optional, timings are converted in plain python without it
+	np = None
+
+from npf_utils import (
+	IS_SUBTITLE_FILE,
+	IS_MISDECODED_POLISH_TEXT,
+	EASTERN_EUROPE,
+	fix,
+	indent,
+	IO_,
+)
+
+
+# === MicroDVD / MPL2 -> SRT ===
+
+# napiprojekt subtitles are often
+#   MicroDVD   {start frame}{end frame}Line 1|Line 2
+#   MPL2       [start ds][end ds]Line 1|/Italic line 2      (deciseconds)
+# A file is parsed with one regex pass into a column of start times, a column
+# of end times and a list of texts. The timings are converted to milliseconds
+# in one vectorized step, and the whole SRT is written with one write.
+# If the text is misdecoded, it's fixed on the way.
+#
+# MicroDVD needs the frame rate: `--fps`, or else the `{1}{1}23.976` line
+# many files start with, or else DEFAULT_FPS.
+
+DEFAULT_FPS = 23.976
+
+# a cue with no end time is shown this long, or until the next one starts
+DEFAULT_DURATION_MS = 3000
+
+MICRODVD, MPL2 = 'microdvd', 'mpl2'
+
+_microdvd_re = re.compile(r'^\{(\d+)\}\{(\d*)\}(.*?)\r?$', re.MULTILINE)
+_mpl2_re     = re.compile(r'^\[(\d+)\]\[(\d*)\](.*?)\r?$',  re.MULTILINE)
+_microdvd_tag_re = re.compile(r'\{[a-zA-Z]:[^}]*\}')
+# {y:i} - this line in italics, {Y:i} - the whole cue. Also {y:b,i} and such
+_microdvd_line_italic_re = re.compile(r'\{y:[^}]*i[^}]*\}')
+_microdvd_cue_italic_re  = re.compile(r'\{Y:[^}]*i[^}]*\}')
+_fps_re = re.compile(r'^\d+(\.\d+)?$')
+
+ParsedSubtitles = namedtuple('ParsedSubtitles', ['format', 'starts', 'ends', 'texts', 'fps'])
+
+
+def detect_format(text: str) -> Optional[str]:
+	first_line = text.lstrip().split('\n', 1)[0]
+	if _microdvd_re.match(first_line):
+		return MICRODVD
+	elif _mpl2_re.match(first_line):
+		return MPL2
+	else:
+		return None
+
+
+def parse(text: str, fps: Optional[float]) -> Optional[ParsedSubtitles]:
+	""" None if `text` isn't MicroDVD or MPL2 """
+	format = detect_format(text)
+	if format is None:
+		return None
+	cue_re = _microdvd_re if format == MICRODVD else _mpl2_re
+	cues = cue_re.findall(text)
+
+	if format == MICRODVD:
+		start, _, first_text = cues[0]
+		if start in ('0', '1') and _fps_re.match(first_text.strip()):
+			# {1}{1}23.976 - the frame rate, not a cue
+			cues = cues[1:]
+			if fps is None:
+				fps = float(first_text.strip())
+		if fps is None:
+			fps = DEFAULT_FPS
+
+	starts = [int(start) for (start, _, _) in cues]
+	ends   = [int(end) if end != '' else -1 for (_, end, _) in cues]
+	texts  = [cue_text for (_, _, cue_text) in cues]
+	return ParsedSubtitles(format, starts, ends, texts, fps)
+
+
+def to_milliseconds(parsed: ParsedSubtitles) -> Tuple[Sequence[int], Sequence[int]]:
+	"""
+	start and end times of the cues in ms.
+	A missing end (-1) becomes the next cue's start, or DEFAULT_DURATION_MS later, whichever is sooner.
+	"""
+	ms_per_unit = 1000.0 / parsed.fps if parsed.format == MICRODVD else 100.0
+	if np is not None:
+		starts = np.rint(np.array(parsed.starts, dtype=np.float64) * ms_per_unit).astype(np.int64)
+		ends   = np.array(parsed.ends, dtype=np.float64)
+		ends   = np.where(ends < 0, -1, np.rint(ends * ms_per_unit)).astype(np.int64)
+		next_starts = np.append(starts[1:], np.iinfo(np.int64).max)
+		ends = np.where(ends < 0, np.minimum(starts + DEFAULT_DURATION_MS, next_starts), ends)
+		return (starts, ends)
+
+	starts = [int(round(start * ms_per_unit)) for start in parsed.starts]
+	next_starts = starts[1:] + [float('inf')]
+	ends = [ int(round(end * ms_per_unit)) if end >= 0 else min(start + DEFAULT_DURATION_MS, next_start)
+			 for (start, end, next_start) in zip(starts, parsed.ends, next_starts) ]
+	return (starts, ends)
+
+
+def srt_timestamps(ms: Sequence[int]) -> List[str]:
+	if np is not None:
+		ms = np.asarray(ms, dtype=np.int64)
+		columns = (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+		return [ '{:02}:{:02}:{:02},{:03}'.format(h, m, s, f)
+				 for (h, m, s, f) in zip(*(column.tolist() for column in columns)) ]
+	return [ '{:02}:{:02}:{:02},{:03}'.format(t // 3600000, t // 60000 % 60, t // 1000 % 60, t % 1000)
+			 for t in ms ]
+
+
+def srt_text(cue_text: str, format: str) -> str:
+	lines = cue_text.split('|')
+	if format == MICRODVD:
+		cue_italic = _microdvd_cue_italic_re.search(cue_text) is not None
+		lines = [ '<i>' + _microdvd_tag_re.sub('', line) + '</i>'
+				  if cue_italic or _microdvd_line_italic_re.search(line) is not None
+				  else _microdvd_tag_re.sub('', line)
+				  for line in lines ]
+	else:
+		lines = ['<i>' + line[1:] + '</i>' if line.startswith('/') else line for line in lines]
+	return str.join('\n', lines)
+
+
+def to_srt(parsed: ParsedSubtitles) -> str:
+	starts, ends = to_milliseconds(parsed)
+	cues = [ '{}\n{} --> {}\n{}\n'.format(i, start, end, srt_text(cue_text, parsed.format))
+			 for (i, (start, end, cue_text))
+			 in enumerate(zip(srt_timestamps(starts), srt_timestamps(ends), parsed.texts), 1) ]
+	return str.join('\n', cues)
+
+
+
+# === Converting files ===
+
+def read_subtitle_text(filename: str) -> IO_[Tuple[str, bool]]:
+	"""
+	(the text, whether it needed fixing). napiprojekt files are sometimes
+	plain windows-1250 instead of UTF-8 - those are decoded as such.
+	"""
+	with open(filename, mode='rb') as file:
+		data = file.read()
+	try:
+		text = data.decode('utf-8-sig')
+	except UnicodeDecodeError:
+		return (data.decode(EASTERN_EUROPE, errors='replace'), True)
+	if IS_MISDECODED_POLISH_TEXT.pred(text):
+		return (fix(text), True)
+	return (text, False)
+
+
+def srt_filename(filename: str) -> str:
+	return os.path.splitext(filename)[0] + '.srt'
+
+
+def convert_file(filename: str, options: Dict[str, Any]) -> IO_[Tuple[bool, str]]:
+	""" Writes FILE.srt next to FILE. Returns (whether it was converted, what happened) """
+	target = srt_filename(filename)
+	if os.path.exists(target):
+		return (False, "not converting, {} already exists".format(target))
+
+	text, was_fixed = read_subtitle_text(filename)
+	parsed = parse(text, options['fps'])
+	if parsed is None:
+		return (False, "not MicroDVD or MPL2, not converting")
+	if len(parsed.texts) == 0:
+		return (False, "no cues, not converting")  # e.g. only the {1}{1}23.976 header
+
+	srt = to_srt(parsed)
+	# 'x' - never overwrite an .srt that appeared in the meantime
+	with open(target, mode='x', encoding='utf-8-sig') as file:
+		file.write(srt)
+
+	details = ", {} fps".format(parsed.fps) if parsed.format == MICRODVD else ""
+	return (True, "converted {} cues from {}{}{} -> {}" \
+				  .format(len(parsed.texts), parsed.format, details, ", fixed" if was_fixed else "", target))
+
+
+def convert_files(filenames: Sequence[str], options: Dict[str, Any]) -> IO_[None]:
+	n_converted = 0
+	for filename in filenames:
+		if not IS_SUBTITLE_FILE.pred(filename) or filename.endswith('.srt'):
+			continue
+		print(filename)
+		try:
+			converted, message = convert_file(filename, options)
+		except (OSError, ValueError) as err:
+			converted, message = False, "Error: " + str(err)
+		n_converted += converted
+		print(indent(message, 4))
+	print()
+	print("Converted {} files to SRT.".format(n_converted))
@@ -0,0 +1,172 @@
+import os
+import hashlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+from npf_utils import (
+	FileEntry,
+	FileProperty,
+	IS_SUBTITLE_FILE,
+	content_file_props,
+	file_contents,
+	fix,
+	IO_,
+)
+
+
+# === Content-hash deduplication ===
+
+# Identical files are found in three rounds, each one only looking at the
+# files that are still ambiguous after the previous one:
+#   1. size           (free, comes from the directory listing)
+#   2. first block    (one small read per file)
+#   3. whole contents
+# So a file with a unique size is never read here at all. Only subtitle files
+# are compared - videos are never read.
+
+PREFIX_BLOCK_SIZE = 64 * 1024
+READ_BLOCK_SIZE   = 1024 * 1024
+
+
+def file_digest(filename: str, limit: Optional[int] = None) -> IO_[str]:
+	""" sha1 of the file's raw bytes (only the first `limit` bytes if given) """
+	h = hashlib.sha1()
+	with open(filename, mode='rb') as file:
+		if limit is not None:
+			h.update(file.read(limit))
+		else:
+			for block in iter(lambda: file.read(READ_BLOCK_SIZE), b''):
+				h.update(block)
+	return h.hexdigest()
+
+
+def _split_by(key, entries: Sequence[FileEntry]) -> List[List[FileEntry]]:
+	groups = defaultdict(list)
+	for entry in entries:
+		groups[key(entry)].append(entry)
+	return [group for group in groups.values() if len(group) > 1]
+
+
+def find_identical_files(entries: Sequence[FileEntry]) -> IO_[Dict[str, str]]:
+	"""
+	Returns {path: digest} for every subtitle file that has at least one identical
+	copy among `entries`. Files with unique contents are left out, and other
+	files (videos) are never read.
+	"""
+	subtitle_entries = [entry for entry in entries if IS_SUBTITLE_FILE.pred(entry.path)]
+	digests = {}
+	for same_size in _split_by(lambda e: e.size, subtitle_entries):
+		if same_size[0].size <= PREFIX_BLOCK_SIZE:
+			# the first block is the whole file
+			candidates = [same_size]
+		else:
+			candidates = _split_by(lambda e: file_digest(e.path, PREFIX_BLOCK_SIZE), same_size)
+
+		for group in candidates:
+			full_digests = {e.path: file_digest(e.path) for e in group}
+			for same_contents in _split_by(lambda e: full_digests[e.path], group):
+				for entry in same_contents:
+					digests[entry.path] = full_digests[entry.path]
+	return digests
+
+
+
+class DedupIndex:
+	"""
+	Remembers everything computed from a file's contents
+	(`content_file_props` results and the fixed text),
+	so it's computed once per distinct content and reused for every copy.
+	Results are dropped when the last copy has been processed.
+	"""
+
+	def __init__(self, entries: Sequence[FileEntry]):
+		self.digests = find_identical_files(entries)
+		self.copies_left = defaultdict(int)
+		for digest in self.digests.values():
+			self.copies_left[digest] += 1
+
+		self.prop_results = defaultdict(dict)  # digest -> {prop index: bool}
+		self.fixed        = {}  # digest -> fixed text
+		self.fixed_paths  = {}  # digest -> path of a copy that was already fixed
+		self.first_paths  = {}  # digest -> path of the first copy seen
+
+		self.n_duplicates = len(self.digests) - len(self.copies_left)
+
+
+	def digest_of(self, filename: str) -> Optional[str]:
+		return self.digests.get(filename, None)
+
+
+	def original_of(self, filename: str) -> Optional[str]:
+		"""
+		Returns the first processed file with the same contents as `filename`,
+		or None if there is none (yet).
+		"""
+		digest = self.digest_of(filename)
+		if digest is None:
+			return None
+		original = self.first_paths.setdefault(digest, filename)
+		return original if original != filename else None
+
+
+	def memoized_props(self, props: Sequence[FileProperty]) -> List[FileProperty]:
+		""" wraps the content props in `props` so that their results are shared between copies """
+		return [ self._memoized_prop(prop_index, prop) if prop in content_file_props else prop
+				 for (prop_index, prop) in enumerate(props) ]
+
+	def _memoized_prop(self, prop_index: int, prop: FileProperty) -> FileProperty:
+		def memoized_pred(filename: str) -> bool:
+			digest = self.digest_of(filename)
+			if digest is None:
+				return prop.pred(filename)
+			results = self.prop_results[digest]
+			if prop_index not in results:
+				results[prop_index] = prop.pred(filename)
+			return results[prop_index]
+
+		return FileProperty(prop.true_text, prop.false_text, memoized_pred)
+
+
+	def fixed_text(self, filename: str) -> IO_[str]:
+		digest = self.digest_of(filename)
+		if digest is None:
+			return fix(file_contents(filename))
+		if digest not in self.fixed:
+			self.fixed[digest] = fix(file_contents(filename))
+		return self.fixed[digest]
+
+
+	def fixed_copy_of(self, filename: str) -> Optional[str]:
+		""" a file with the same original contents that has already been fixed """
+		digest = self.digest_of(filename)
+		return self.fixed_paths.get(digest, None) if digest is not None else None
+
+	def mark_fixed(self, filename: str) -> None:
+		digest = self.digest_of(filename)
+		if digest is not None:
+			self.fixed_paths.setdefault(digest, filename)
+
+
+	def done(self, filename: str) -> None:
+		digest = self.digest_of(filename)
+		if digest is None:
+			return
+		self.copies_left[digest] -= 1
+		if self.copies_left[digest] == 0:
+			del self.copies_left[digest]
+			self.fixed.pop(digest, None)
+			self.fixed_paths.pop(digest, None)
+			self.first_paths.pop(digest, None)
+			self.prop_results.pop(digest, None)
+
+
+
+def hardlink_to(source: str, filename: str) -> IO_[None]:
+	""" atomically replaces `filename` with a hard link to `source` """
+	tmp_filename = filename + '.npf-link'
+	os.link(source, tmp_filename)
+	try:
+		os.replace(tmp_filename, filename)
+	except OSError:
+		os.remove(tmp_filename)
+		raise
@@ -0,0 +1,159 @@
+import os
+import re
+from collections import namedtuple, defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from npf_utils import (
+	FileEntry,
+	video_exts,
+	file_ext,
+)
+
+
+# === Matching subtitles to videos by episode name ===
+
+# Subtitles often don't have exactly the same name as their video, and aren't
+# in the same directory:
+#     Show.S01E02.720p.HDTV.x264.mkv
+#     Subs/show s01e02.srt
+# So names are normalized into an EpisodeKey (lowercase show name words,
+# season, episode), dropping separators, years and release tags, and all the
+# videos in the library are put in a dict by their key, once per run.
+# Matching a subtitle is then a dict lookup instead of probing the filesystem.
+
+EpisodeKey = namedtuple('EpisodeKey', ['show', 'season', 'episode'])
+
+_separators_re = re.compile(r'[\s._\-\[\]()]+')
+_episode_re = re.compile(r'^s(\d{1,2})e(\d{1,3})$|^(\d{1,2})x(\d{2,3})$')
+_split_episode_re = re.compile(r'^s(\d{1,2})$')           # 'S01 E02'
+_split_episode_next_re = re.compile(r'^e(\d{1,3})$')
+_year_re = re.compile(r'^(19|20)\d\d$')
+
+release_tags = set([
+	'480p', '576p', '720p', '1080p', '1080i', '2160p', '4k', 'uhd',
+	'x264', 'x265', 'h264', 'h265', 'hevc', 'avc', 'xvid', 'divx', '10bit',
+	'hdtv', 'pdtv', 'web', 'webrip', 'webdl', 'dl', 'bluray', 'bdrip', 'brrip', 'dvdrip', 'hdrip', 'dvd',
+	'aac', 'ac3', 'dts', 'dd5', 'mp3',
+	'proper', 'repack', 'internal', 'extended', 'limited', 'multi', 'pl', 'eng', 'napisy', 'subs',
+])
+
+
+def episode_key(filename: str) -> EpisodeKey:
+	"""
+	>>> episode_key('Show.S01E02.720p.HDTV.x264.mkv')
+	EpisodeKey(show='show', season=1, episode=2)
+	>>> episode_key('Subs/show s01e02.srt')
+	EpisodeKey(show='show', season=1, episode=2)
+	>>> episode_key('The.Movie.2009.1080p.BluRay.mkv')
+	EpisodeKey(show='the movie', season=None, episode=None)
+	>>> episode_key('Doctor.Who.2005.S01E01.mkv')
+	EpisodeKey(show='doctor who', season=1, episode=1)
+	>>> episode_key('Subs/doctor who s01e01.srt')
+	EpisodeKey(show='doctor who', season=1, episode=1)
+	"""
+	stem, _ = os.path.splitext(os.path.basename(filename))
+	words = [word for word in _separators_re.split(stem.lower()) if word != '']
+
+	show_words = []
+	title_ended = False
+	season, episode = None, None
+	i = 0
+	while i < len(words):
+		word = words[i]
+		o_match = _episode_re.match(word)
+		o_split = _split_episode_re.match(word)
+		o_split_next = _split_episode_next_re.match(words[i+1]) if i+1 < len(words) else None
+
+		if o_match is not None:
+			season_s, episode_s = (o_match.group(1), o_match.group(2)) if o_match.group(1) is not None \
+								  else (o_match.group(3), o_match.group(4))
+			season, episode = int(season_s), int(episode_s)
+			break  # everything after the episode number is the episode title and release info
+		elif o_split is not None and o_split_next is not None:
+			season, episode = int(o_split.group(1)), int(o_split_next.group(1))
+			break
+		elif _year_re.match(word) or word in release_tags:
+			# 'The.Movie.2009.1080p...' - the title ends here, but the episode
+			# may still follow ('Doctor.Who.2005.S01E01')
+			title_ended = title_ended or len(show_words) > 0
+		elif not title_ended:
+			show_words.append(word)
+		i += 1
+
+	return EpisodeKey(str.join(' ', show_words), season, episode)
+
+
+def _dirs_near(path: str) -> Tuple[str, str]:
+	# a subtitle's own directory and the one above it (for 'Subs/' folders)
+	dirname = os.path.dirname(os.path.abspath(path))
+	return (dirname, os.path.dirname(dirname))
+
+
+class VideoIndex:
+	""" All the videos of a library, by episode key. Built once per run. """
+
+	def __init__(self, video_paths: Sequence[str]):
+		self.by_key = defaultdict(list)                 # EpisodeKey -> [video path]
+		self.by_episode_in_dir = defaultdict(list)      # (season, episode, dir)        -> [(show, video path)]
+		self.by_episode_in_subdir = defaultdict(list)   # (season, episode, parent dir) -> [(show, video path)]
+		for path in video_paths:
+			key = episode_key(path)
+			self.by_key[key].append(path)
+			if key.season is not None:
+				dirname = os.path.dirname(os.path.abspath(path))
+				self.by_episode_in_dir[(key.season, key.episode, dirname)].append((key.show, path))
+				self.by_episode_in_subdir[(key.season, key.episode, os.path.dirname(dirname))].append((key.show, path))
+		self.n_videos = len(video_paths)
+
+	@staticmethod
+	def from_entries(entries: Sequence[FileEntry]) -> 'VideoIndex':
+		return VideoIndex([entry.path for entry in entries if file_ext(entry.path).lower() in video_exts])
+
+
+	def video_for(self, subtitle_path: str) -> Optional[str]:
+		"""
+		The video `subtitle_path` belongs to, or None.
+		Prefers videos in the subtitle's directory, then in the directory above it.
+		"""
+		key = episode_key(subtitle_path)
+		if key == EpisodeKey('', None, None):
+			return None  # nothing left of the name to match on
+		near = _dirs_near(subtitle_path)
+
+		candidates = self.by_key.get(key, [])
+		if len(candidates) > 0:
+			return _nearest(candidates, near)
+
+		if key.season is not None:
+			# same episode number, and the show names don't contradict each other
+			# ('s01e02.srt', or 'show s01e02' next to 'Show.Name.S01E02') - only nearby
+			own_dir, parent_dir = near
+			nearby = self.by_episode_in_dir.get((key.season, key.episode, own_dir), []) \
+				   + self.by_episode_in_dir.get((key.season, key.episode, parent_dir), []) \
+				   + self.by_episode_in_subdir.get((key.season, key.episode, parent_dir), [])
+			for (show, video) in nearby:
+				if _show_names_agree(key.show, show):
+					return video
+
+		return None
+
+
+def _show_names_agree(show1: str, show2: str) -> bool:
+	return show1 == '' or show2 == '' or show1.startswith(show2) or show2.startswith(show1)
+
+
+def _nearest(candidates: List[str], near: Tuple[str, str]) -> str:
+	own_dir, parent_dir = near
+	by_dir = {}  # type: Dict[str, str]
+	for video in candidates:
+		by_dir.setdefault(os.path.dirname(os.path.abspath(video)), video)
+
+	for dirname in near:
+		if dirname in by_dir:
+			return by_dir[dirname]
+	# sibling directories, e.g. 'Season 1/Subs' and 'Season 1/Video'
+	for (dirname, video) in by_dir.items():
+		if os.path.dirname(dirname) == parent_dir:
+			return video
+
+	return candidates[0]
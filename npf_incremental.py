@@ -0,0 +1,195 @@
+import os
+import json
+import codecs
+import hashlib
+import shutil
+from collections import namedtuple
+from typing import Any, Dict, Optional, Tuple
+
+from npf_undo import UTF8_BOM
+from npf_utils import (
+	IS_SUBTITLE_FILE,
+	IS_MISDECODED_POLISH_FILE,
+	misdecoded_polish_chars_no_dup,
+	polish_chars_no_dup,
+	any_in,
+	fix,
+	indent,
+	IO_,
+)
+
+
+# === Incremental fixing of growing files ===
+
+# A file that is still being written (live transcription, partial downloads)
+# can't just be processed again every time - `fix` isn't idempotent, so the part
+# that was already fixed would get mangled. Instead we remember how far into the
+# file we got, and only read, classify and fix what was appended since.
+#
+# The verdict is the same as IS_MISDECODED_POLISH_FILE on the original text,
+# tracked incrementally: the file is misdecoded if the original text seen so
+# far has some misdecoded chars and no polish chars. The already-fixed prefix
+# isn't scanned again, so `seen_misdecoded` and `seen_polish` are stored too.
+#
+# To notice when the file was replaced or rewritten instead of appended to,
+# the state also has the inode and a checksum of the last CHECKSUM_WINDOW bytes
+# before `offset`. If they don't match, the file is processed from the start.
+#
+# The writer may still be writing at absolute offsets (a downloader filling in
+# a partial file), so fixed bytes only ever overwrite the original bytes they
+# replace, in place: the file keeps its BOM (or lack of one), and a part whose
+# fixed bytes aren't exactly as long as the original ones isn't fixed yet -
+# moving everything after it would put the writer's next bytes in the wrong place.
+# Backups are .bak copies that grow with the file; the undo journal
+# (`--backup-method`) can't record a file that's still changing.
+
+IncrementalState = namedtuple('IncrementalState', [
+	'offset',           # bytes processed so far, always on a character boundary
+	'verdict',          # was the file misdecoded (and fixed) up to `offset`
+	'seen_misdecoded',  # original text up to `offset` had misdecoded chars
+	'seen_polish',      # original text up to `offset` had polish chars
+	'inode',
+	'checksum',         # of the CHECKSUM_WINDOW bytes before `offset`
+])
+
+CHECKSUM_WINDOW = 4096
+
+
+def state_filename(filename: str, state_dir: str) -> str:
+	key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+	return os.path.join(state_dir, key + '.json')
+
+def load_state(filename: str, state_dir: str) -> IO_[Optional[IncrementalState]]:
+	try:
+		with open(state_filename(filename, state_dir), mode='r', encoding='utf-8') as file:
+			return IncrementalState(**json.load(file))
+	except (OSError, ValueError, TypeError):
+		return None
+
+def save_state(filename: str, state_dir: str, state: IncrementalState) -> IO_[None]:
+	os.makedirs(state_dir, exist_ok=True)
+	path = state_filename(filename, state_dir)
+	with open(path + '.tmp', mode='w', encoding='utf-8') as file:
+		json.dump(state._asdict(), file)
+	os.replace(path + '.tmp', path)
+
+
+def tail_checksum(file, offset: int) -> IO_[str]:
+	start = max(0, offset - CHECKSUM_WINDOW)
+	file.seek(start)
+	return hashlib.sha1(file.read(offset - start)).hexdigest()
+
+
+def decode_complete(data: bytes, at_start: bool) -> Tuple[str, int]:
+	"""
+	Decodes as much of `data` as forms complete characters.
+	Returns the text and the number of bytes it took up - a character still
+	being written at the end of the file is left for next time.
+	"""
+	decoder = codecs.getincrementaldecoder('utf-8-sig' if at_start else 'utf-8')()
+	text = decoder.decode(data, final=False)
+	pending_bytes, _ = decoder.getstate()
+	return (text, len(data) - len(pending_bytes))
+
+
+
+def process_growing_file(filename: str, options: Dict[str, Any]) -> IO_[None]:
+	state_dir = options['incremental_state_dir']
+	print(filename)
+	if not IS_SUBTITLE_FILE.pred(filename):
+		print(indent(IS_SUBTITLE_FILE.false_text, 4))
+		print("Not fixing.")
+		return
+
+	with open(filename, mode='rb') as file:
+		st = os.fstat(file.fileno())
+		state = load_state(filename, state_dir)
+
+		if state is not None and not (state.inode == st.st_ino
+									  and state.offset <= st.st_size
+									  and state.checksum == tail_checksum(file, state.offset)):
+			print(indent("file was changed, not only appended to - starting over", 4))
+			state = None
+
+		if state is None:
+			state = IncrementalState(0, False, False, False, st.st_ino, '')
+
+		file.seek(state.offset)
+		new_data = file.read()
+
+	if state.offset > 0:
+		print(indent("already processed: {} bytes, new: {} bytes".format(state.offset, len(new_data)), 4))
+
+	new_text, n_consumed = decode_complete(new_data, at_start=(state.offset == 0))
+	if n_consumed == 0:
+		print("No new data.")
+		return
+
+	seen_misdecoded = state.seen_misdecoded or any_in(new_text, misdecoded_polish_chars_no_dup)
+	seen_polish     = state.seen_polish     or any_in(new_text, polish_chars_no_dup)
+	verdict = seen_misdecoded and not seen_polish
+
+	print(indent(IS_MISDECODED_POLISH_FILE.true_text if verdict else IS_MISDECODED_POLISH_FILE.false_text, 4))
+
+	if verdict and (state.offset == 0 or not state.verdict):
+		# the whole file has to be fixed - either it's new, or the first misdecoded
+		# chars just showed up and the (so far unfixed) prefix needs fixing too
+		end = state.offset + n_consumed
+		with open(filename, mode='rb') as file:
+			original = file.read(end)
+		text, _ = decode_complete(original, at_start=True)
+		bom = UTF8_BOM if original.startswith(UTF8_BOM) else b''
+		fixed = bom + fix(text).encode('utf-8')
+		if len(fixed) != end:
+			_postpone(filename)
+			return
+		print("Fixing " + filename)
+		if options['backup']:
+			shutil.copy(filename, filename+'.bak')
+			if options['backup_method'] != 'copy':
+				print(indent("backed up to {} - the undo journal can't record a growing file".format(filename+'.bak'), 4))
+		new_offset = _rewrite_in_place(filename, 0, fixed)
+		print('Success')
+
+	elif verdict:
+		fixed = fix(new_text).encode('utf-8')
+		if len(fixed) != n_consumed:
+			_postpone(filename)
+			return
+		print("Fixing new part of " + filename)
+		if options['backup']:
+			# the backup stays a copy of the original file
+			with open(filename+'.bak', mode='ab') as bak:
+				bak.write(new_data[:n_consumed])
+		new_offset = _rewrite_in_place(filename, state.offset, fixed)
+		print('Success')
+
+	else:
+		if state.verdict:
+			print(indent("polish characters were appended to a fixed file - not fixing the new part", 4))
+		print("Not fixing.")
+		new_offset = state.offset + n_consumed
+
+	with open(filename, mode='rb') as file:
+		checksum = tail_checksum(file, new_offset)
+
+	save_state(filename, state_dir,
+			   IncrementalState(new_offset, verdict, seen_misdecoded, seen_polish, st.st_ino, checksum))
+
+
+def _rewrite_in_place(filename: str, start: int, replacement: bytes) -> IO_[int]:
+	"""
+	Overwrites the bytes from `start` on with `replacement`, which is exactly as
+	long as what it replaces - anything appended in the meantime isn't touched.
+	Returns the offset where `replacement` ends.
+	"""
+	with open(filename, mode='r+b') as file:
+		file.seek(start)
+		file.write(replacement)
+	return start + len(replacement)
+
+
+def _postpone(filename: str) -> IO_[None]:
+	# the state isn't saved, so the same bytes are looked at again next time
+	print(indent("fixing would change the length of the file while it may still be written to", 4))
+	print("Not fixing yet - run npf.py without --incremental on {} once it's complete.".format(filename))
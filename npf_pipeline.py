@@ -0,0 +1,269 @@
+import threading
+import time
+import queue
+from collections import namedtuple
+from typing import Any, Dict, List, Optional, Sequence
+
+from npf_utils import (
+	FileEntry,
+	FileProperty,
+	IS_SUBTITLE_FILE,
+	IS_MISDECODED_POLISH_FILE,
+	IS_MISDECODED_POLISH_TEXT,
+	file_has_properties_detailed,
+	fix,
+	FileResult,
+	Fixed,
+	NotFixed,
+	Failed,
+	indent,
+	IO_,
+)
+from npf_progress import Progress, ProgressCounters
+from npf_undo import backup_and_write_fixed
+from npf_schedule import with_read_ahead
+
+
+# === Bounded parallel pipeline ===
+
+#   list -> read -> classify -> fix -> write
+#
+# Stages are connected by bounded queues, and a file is only admitted into
+# the pipeline once its bytes fit into the memory budget. The budget is
+# released when the file leaves the pipeline, so the amount of file data
+# in flight stays under the budget no matter how many workers there are.
+#
+# Non-subtitle files are never read - they can't be fixed anyway, and they
+# can be arbitrarily large (videos).
+
+# A file of n bytes is held as raw bytes, then as decoded text and fixed text
+# (up to 2 bytes per character for polish text) - count it as this many bytes.
+IN_FLIGHT_BYTES_PER_FILE_BYTE = 4
+
+MB = 1024 * 1024
+
+
+class ByteBudget:
+	""" A counting semaphore for bytes. Records how long admission was blocked. """
+
+	def __init__(self, limit: int):
+		self.limit = limit
+		self.in_flight = 0
+		self.max_in_flight = 0
+		self.n_waits = 0
+		self.wait_seconds = 0.0
+		self.cond = threading.Condition()
+
+	def acquire(self, n_bytes: int) -> None:
+		with self.cond:
+			if not self._fits(n_bytes):
+				self.n_waits += 1
+				start = time.monotonic()
+				while not self._fits(n_bytes):
+					self.cond.wait()
+				self.wait_seconds += time.monotonic() - start
+
+			self.in_flight += n_bytes
+			self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+	def release(self, n_bytes: int) -> None:
+		with self.cond:
+			self.in_flight -= n_bytes
+			self.cond.notify_all()
+
+	def _fits(self, n_bytes: int) -> bool:
+		# a file bigger than the whole budget gets in alone
+		return self.in_flight == 0 or self.in_flight + n_bytes <= self.limit
+
+
+
+class StageQueue:
+	""" A bounded queue that records how long producers were blocked on it (backpressure). """
+
+	def __init__(self, name: str, maxsize: int):
+		self.name = name
+		self.queue = queue.Queue(maxsize)
+		self.n_blocked_puts = 0
+		self.blocked_seconds = 0.0
+		self.stats_lock = threading.Lock()
+
+	def put(self, item) -> None:
+		try:
+			self.queue.put_nowait(item)
+		except queue.Full:
+			start = time.monotonic()
+			self.queue.put(item)
+			with self.stats_lock:
+				self.n_blocked_puts += 1
+				self.blocked_seconds += time.monotonic() - start
+
+	def get(self):
+		return self.queue.get()
+
+
+
+PipelineItem = namedtuple('PipelineItem', ['entry', 'cost', 'data', 'text', 'should_fix', 'reasons', 'fixed', 'error'])
+
+_DONE = None  # end-of-stream marker
+
+
+def text_prop_for(text: str) -> FileProperty:
+	# IS_MISDECODED_POLISH_FILE, but for a file that's already been read
+	return FileProperty(IS_MISDECODED_POLISH_FILE.true_text,
+						IS_MISDECODED_POLISH_FILE.false_text,
+						lambda filename: IS_MISDECODED_POLISH_TEXT.pred(text))
+
+
+def _stage(func, in_q: StageQueue, out_q: StageQueue):
+	def run():
+		while True:
+			item = in_q.get()
+			if item is _DONE:
+				return
+			if item.error is None:
+				try:
+					item = func(item)
+				except Exception as err:
+					item = item._replace(data=None, text=None, fixed=None, error=err)
+			out_q.put(item)
+	return run
+
+
+def _read(item: PipelineItem) -> PipelineItem:
+	with open(item.entry.path, mode='rb') as file:
+		return item._replace(data=file.read())
+
+def _classify(options: Dict[str, Any]):
+	def classify(item: PipelineItem) -> PipelineItem:
+		text = item.data.decode('utf-8-sig')
+		should_fix, reasons = file_has_properties_detailed(
+								item.entry.path, [IS_SUBTITLE_FILE, text_prop_for(text)] + options['extra_file_props'],
+								options['show_file_processing_reasons'])
+		return item._replace(data=None, text=text, should_fix=should_fix, reasons=reasons)
+	return classify
+
+def _fix(item: PipelineItem) -> PipelineItem:
+	if not item.should_fix:
+		return item._replace(text=None)
+	return item._replace(text=None, fixed=fix(item.text))
+
+
+
+def run_pipeline(entries: Sequence[FileEntry], options: Dict[str, Any]) -> IO_[int]:
+	""" Returns how many files failed. """
+	n_workers = options['workers']
+	budget = ByteBudget(options['memory_budget'] * MB)
+
+	queue_size = 2 * n_workers
+	read_q     = StageQueue('read',     queue_size)
+	classify_q = StageQueue('classify', queue_size)
+	fix_q      = StageQueue('fix',      queue_size)
+	write_q    = StageQueue('write',    queue_size)
+	stages = [
+		(read_q,     classify_q, _read),
+		(classify_q, fix_q,      _classify(options)),
+		(fix_q,      write_q,    _fix),
+	]
+
+	stage_threads = []
+	for (in_q, out_q, func) in stages:
+		threads = [threading.Thread(target=_stage(func, in_q, out_q), daemon=True)
+				   for _ in range(n_workers)]
+		for thread in threads:
+			thread.start()
+		stage_threads.append((in_q, threads))
+
+	progress = Progress(entries) if options['progress'] else None
+	counters = progress.new_counters() if progress is not None else None
+
+	failed = []  # type: List[str]  (only the writer appends)
+	writer = threading.Thread(target=_write_all, args=(write_q, budget, counters, failed, options), daemon=True)
+	writer.start()
+	if progress is not None:
+		progress.start()
+
+
+	# list
+	for entry in with_read_ahead(entries, options):
+		if IS_SUBTITLE_FILE.pred(entry.path):
+			cost = entry.size * IN_FLIGHT_BYTES_PER_FILE_BYTE
+			budget.acquire(cost)
+			read_q.put(PipelineItem(entry, cost, None, None, None, None, None, None))
+		else:
+			_, reasons = file_has_properties_detailed(entry.path, [IS_SUBTITLE_FILE],
+													  options['show_file_processing_reasons'])
+			write_q.put(PipelineItem(entry, 0, None, None, False, reasons, None, None))
+
+	# shut down stage by stage, so that everything upstream is flushed first
+	for (in_q, threads) in stage_threads:
+		for _ in threads:
+			in_q.put(_DONE)
+		for thread in threads:
+			thread.join()
+	write_q.put(_DONE)
+	writer.join()
+	if progress is not None:
+		progress.stop()
+
+	print_pipeline_stats(budget, [read_q, classify_q, fix_q, write_q])
+	if len(failed) > 0:
+		print("Failed: {} files".format(len(failed)))
+	return len(failed)
+
+
+def _write_all(write_q: StageQueue, budget: ByteBudget,
+			   counters: Optional[ProgressCounters], failed: List[str], options: Dict[str, Any]) -> IO_[None]:
+	# the only stage that prints, so per-file reports don't interleave
+	while True:
+		item = write_q.get()
+		if item is _DONE:
+			return
+		try:
+			result = _write(item, options)
+		except Exception as err:
+			print("Error: " + str(err))
+			result = Failed(item.entry.path, str(err))
+		finally:
+			budget.release(item.cost)
+		print()
+		if result.is_Failed():
+			failed.append(item.entry.path)
+		if counters is not None:
+			counters.file_done(item.entry.size, result)
+
+
+def _write(item: PipelineItem, options: Dict[str, Any]) -> IO_[FileResult]:
+	filename = item.entry.path
+	print(filename)
+	if item.error is not None:
+		print(indent("Error: " + str(item.error), 4))
+		return Failed(filename, str(item.error))
+
+	print(str.join('\n', map(lambda s: indent(s, 4), item.reasons) ))
+
+	if item.should_fix:
+		print("Fixing " + filename)
+
+		n_bytes = backup_and_write_fixed(filename, item.fixed, options)
+
+		if n_bytes > 0:
+			print('Success')
+		elif n_bytes == 0:
+			print('No bytes written.')
+		else:
+			print('Error: could not write to file')
+		return Fixed(filename, n_bytes)
+	else:
+		print("Not fixing.")
+		return NotFixed(filename)
+
+
+def print_pipeline_stats(budget: ByteBudget, queues: List[StageQueue]) -> IO_[None]:
+	print("Pipeline stats:")
+	print(indent("memory budget: {:.1f} MB, peak in flight: {:.1f} MB" \
+				 .format(budget.limit / MB, budget.max_in_flight / MB), 4))
+	print(indent("waited for budget: {} times, {:.2f}s" \
+				 .format(budget.n_waits, budget.wait_seconds), 4))
+	for q in queues:
+		print(indent("{} queue full: {} times, {:.2f}s" \
+					 .format(q.name, q.n_blocked_puts, q.blocked_seconds), 4))
@@ -0,0 +1,126 @@
+import sys
+import time
+import threading
+from typing import List, Sequence
+
+from npf_utils import (
+	FileEntry,
+	FileResult,
+	IO_,
+)
+
+
+# === Progress reporting ===
+
+# Workers never share counters: each one gets its own `ProgressCounters`
+# and is the only one writing to it, so there's no locking on the per-file path.
+# A single reporter thread adds them up a few times per second and prints
+# one status line to stderr - rewritten in place on a terminal, or as
+# a periodic log line otherwise.
+
+TTY_UPDATE_INTERVAL = 0.25  # seconds
+LOG_UPDATE_INTERVAL = 10.0
+
+MB = 1024 * 1024
+
+
+class ProgressCounters:
+	__slots__ = ('n_files', 'n_bytes', 'n_fixed', 'n_skipped', 'n_failed')
+
+	def __init__(self):
+		self.n_files   = 0
+		self.n_bytes   = 0
+		self.n_fixed   = 0
+		self.n_skipped = 0
+		self.n_failed  = 0
+
+	def file_done(self, size: int, result: FileResult) -> None:
+		self.n_files += 1
+		self.n_bytes += size
+		if result.is_Fixed():
+			self.n_fixed += 1
+		elif result.is_NotFixed():
+			self.n_skipped += 1
+		else:
+			self.n_failed += 1
+
+
+class Progress:
+
+	def __init__(self, entries: Sequence[FileEntry], stream=None):
+		self.total_files = len(entries)
+		self.total_bytes = sum(entry.size for entry in entries)
+		self.stream = stream if stream is not None else sys.stderr
+		self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+		self.interval = TTY_UPDATE_INTERVAL if self.is_tty else LOG_UPDATE_INTERVAL
+
+		self.all_counters = []  # type: List[ProgressCounters]
+		self.start_time = None
+		self.stopped = threading.Event()
+		self.reporter = None
+
+	def new_counters(self) -> ProgressCounters:
+		""" counters for one worker. Get them before starting the worker. """
+		counters = ProgressCounters()
+		self.all_counters.append(counters)
+		return counters
+
+
+	def start(self) -> None:
+		self.start_time = time.monotonic()
+		self.reporter = threading.Thread(target=self._report_until_stopped, daemon=True)
+		self.reporter.start()
+
+	def stop(self) -> None:
+		self.stopped.set()
+		self.reporter.join()
+		self._report(final=True)
+
+	def _report_until_stopped(self) -> None:
+		while not self.stopped.wait(self.interval):
+			self._report(final=False)
+
+
+	def status_line(self) -> str:
+		n_files   = sum(c.n_files   for c in self.all_counters)
+		n_bytes   = sum(c.n_bytes   for c in self.all_counters)
+		n_fixed   = sum(c.n_fixed   for c in self.all_counters)
+		n_skipped = sum(c.n_skipped for c in self.all_counters)
+		n_failed  = sum(c.n_failed  for c in self.all_counters)
+
+		seconds = max(time.monotonic() - self.start_time, 1e-9)
+		files_per_s = n_files / seconds
+		mb_per_s = n_bytes / MB / seconds
+		percent = 100.0 * n_files / self.total_files if self.total_files > 0 else 100.0
+
+		if n_files == self.total_files:
+			eta = "done in " + format_duration(seconds)
+		elif files_per_s > 0:
+			eta = "ETA " + format_duration((self.total_files - n_files) / files_per_s)
+		else:
+			eta = "ETA ?"
+
+		line = "[{}/{} files {:5.1f}%] {:.1f} files/s  {:.1f} MB/s  fixed {}  skipped {}" \
+			   .format(n_files, self.total_files, percent, files_per_s, mb_per_s, n_fixed, n_skipped)
+		if n_failed > 0:
+			line += "  failed {}".format(n_failed)
+		return line + "  " + eta
+
+	def _report(self, final: bool) -> IO_[None]:
+		line = self.status_line()
+		if self.is_tty:
+			# \033[K clears what's left of a longer previous line
+			self.stream.write('\r' + line + '\033[K' + ('\n' if final else ''))
+		else:
+			self.stream.write(line + '\n')
+		self.stream.flush()
+
+
+def format_duration(seconds: float) -> str:
+	seconds = int(seconds)
+	if seconds < 60:
+		return "{}s".format(seconds)
+	elif seconds < 3600:
+		return "{}m {:02}s".format(seconds // 60, seconds % 60)
+	else:
+		return "{}h {:02}m".format(seconds // 3600, seconds % 3600 // 60)
@@ -0,0 +1,171 @@
+import os
+import time
+import struct
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+	import fcntl
+except ImportError:  # not on Windows - no FIEMAP there
+	fcntl = None
+
+from npf_utils import (
+	FileEntry,
+	IS_SUBTITLE_FILE,
+	io_orders,
+	indent,
+	IO_,
+)
+
+
+# === I/O scheduling for spinning disks ===
+
+# On a HDD, reading files in `os.listdir` order means seeking all over the disk.
+# Reading them in inode order, or better, in the order their data is laid out
+# on the disk (the physical offset of their first extent, from FIEMAP),
+# turns that into mostly forward seeks.
+#
+# Files are still grouped by directory (directories ordered by their first
+# file), so the writes of fixed files are grouped by directory too.
+#
+# While a file is processed, the kernel is asked to start reading the next
+# few subtitle files (posix_fadvise WILLNEED) - other files aren't read at
+# all, and asking for a video would pull gigabytes into the page cache.
+# Like the reordering, that's for `--io-order inode/extent` only.
+
+FS_IOC_FIEMAP = 0xC020660B  # linux/fs.h
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')      # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')   # fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+
+
+def first_extent_offset(filename: str) -> IO_[Optional[int]]:
+	""" Physical offset of the file's first extent, or None if it can't be found out. """
+	if fcntl is None:
+		return None
+	request = bytearray(_FIEMAP_HEADER.pack(0, 2**64 - 1, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size))
+	try:
+		with open(filename, mode='rb') as file:
+			fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request, True)
+	except OSError:  # not linux, or a filesystem without FIEMAP
+		return None
+	_, _, _, n_mapped_extents, _, _ = _FIEMAP_HEADER.unpack_from(request)
+	if n_mapped_extents == 0:  # empty file, or data inline in the inode
+		return None
+	_, physical, _, _, _, _, _, _, _ = _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)
+	return physical
+
+
+def order_entries(entries: Sequence[FileEntry], io_order: str) -> IO_[List[FileEntry]]:
+	if io_order == 'listing':
+		return list(entries)
+
+	elif io_order == 'inode':
+		position = lambda entry: entry.inode
+
+	elif io_order == 'extent':
+		offsets = {entry.path: first_extent_offset(entry.path) for entry in entries}
+		if all(offset is None for offset in offsets.values()):
+			position = lambda entry: entry.inode
+		else:
+			# files without extents go first, they don't need seeking
+			position = lambda entry: offsets[entry.path] if offsets[entry.path] is not None else -1
+
+	else:
+		raise ValueError("Unknown I/O order: " + io_order)
+
+	by_dir = OrderedDict()
+	for entry in sorted(entries, key=position):
+		by_dir.setdefault(os.path.dirname(entry.path), []).append(entry)
+	return [entry for dir_entries in by_dir.values() for entry in dir_entries]
+
+
+
+def advise_willneed(filename: str) -> IO_[None]:
+	if not hasattr(os, 'posix_fadvise'):
+		return
+	try:
+		fd = os.open(filename, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+def advise_dontneed(filename: str) -> IO_[None]:
+	if not hasattr(os, 'posix_fadvise'):
+		return
+	with open(filename, mode='rb') as file:
+		os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class ReadAhead:
+	"""
+	Call `reached(i)` before processing filenames[i], and the next `window`
+	files will already be on their way into the page cache.
+	"""
+
+	def __init__(self, filenames: Sequence[str], window: int):
+		self.filenames = filenames
+		self.window = window
+		self.next_to_advise = 0
+
+	def reached(self, index: int) -> IO_[None]:
+		end = min(index + 1 + self.window, len(self.filenames))
+		for i in range(max(self.next_to_advise, index + 1), end):
+			advise_willneed(self.filenames[i])
+		self.next_to_advise = max(self.next_to_advise, end)
+
+
+def with_read_ahead(entries: Sequence[FileEntry], options: Dict[str, Any]):
+	""" yields `entries`, reading ahead of the current one """
+	if options['read_ahead'] == 0 or options['io_order'] == 'listing':
+		for entry in entries:
+			yield entry
+		return
+
+	is_subtitle = [IS_SUBTITLE_FILE.pred(entry.path) for entry in entries]
+	read_ahead = ReadAhead([entry.path for (entry, is_sub) in zip(entries, is_subtitle) if is_sub],
+						   options['read_ahead'])
+	n_subtitles = 0
+	for (entry, is_sub) in zip(entries, is_subtitle):
+		if is_sub:
+			read_ahead.reached(n_subtitles)
+			n_subtitles += 1
+		yield entry
+
+
+
+# === Benchmark ===
+
+def benchmark_io_orders(entries: Sequence[FileEntry], options: Dict[str, Any]) -> IO_[None]:
+	"""
+	Reads all the subtitle files in every I/O order and compares the throughput.
+	Before each pass, the files are dropped from the page cache (POSIX_FADV_DONTNEED),
+	so they really come from the disk - but only clean pages can be dropped, so
+	recently written files may still be cached.
+	The `listing` pass is the baseline, without read-ahead.
+	"""
+	subtitle_entries = [entry for entry in entries if IS_SUBTITLE_FILE.pred(entry.path)]
+	total_bytes = sum(entry.size for entry in subtitle_entries)
+	print("Benchmarking read order on {} subtitle files ({:.1f} MB)" \
+		  .format(len(subtitle_entries), total_bytes / (1024*1024)))
+	if not hasattr(os, 'posix_fadvise'):
+		print("Warning: can't drop files from the page cache here, results will be skewed")
+
+	for io_order in io_orders:
+		ordered = order_entries(subtitle_entries, io_order)
+		for entry in ordered:
+			advise_dontneed(entry.path)
+
+		start = time.monotonic()
+		for entry in with_read_ahead(ordered, dict(options, io_order=io_order)):
+			with open(entry.path, mode='rb') as file:
+				file.read()
+		seconds = max(time.monotonic() - start, 1e-9)
+
+		print(indent("{:8} {:8.3f}s  {:9.1f} files/s  {:8.1f} MB/s" \
+					 .format(io_order, seconds, len(ordered) / seconds,
+							 total_bytes / (1024*1024) / seconds), 4))
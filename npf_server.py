@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import socket
+import signal
+import threading
+import socketserver
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from npf_utils import (
+	IS_SUBTITLE_FILE,
+	IS_MISDECODED_POLISH_TEXT,
+	file_has_properties_detailed,
+	NoReasons,
+	fix,
+	FileResult,
+	Fixed,
+	NotFixed,
+	IO_,
+)
+from npf_pipeline import text_prop_for
+from npf_undo import backup_and_write_fixed
+
+
+# === Resident fixing service ===
+
+# Media managers run a hook once per downloaded subtitle, and most of the
+# time of an `npf.py` run goes to starting the interpreter and importing
+# (building the union types and the character tables), not to the file.
+# `npf.py --serve` does that once and then waits on a UNIX socket;
+# `npfc.py FILE` just forwards the request.
+#
+# Protocol: one JSON object per line, each way. A connection can carry
+# any number of requests.
+#
+#   {"op": "fix",  "path": "/abs/path.srt"}  -> {"ok": true, "result": "Fixed", "n_bytes": 1234, "reasons": [...], "cached": false}
+#   {"op": "scan", "path": "/abs/path.srt"}  -> {"ok": true, "should_fix": true, "reasons": [...], "cached": false}
+#   {"op": "ping"}                           -> {"ok": true, "pid": 123, "n_requests": 45}
+#   {"op": "stop"}                           -> {"ok": true}
+#   anything that goes wrong                 -> {"ok": false, "error": "..."}
+#
+# Verdicts are cached by (device, inode, size, mtime), so asking about an
+# unchanged file again doesn't read it. That key isn't enough to never fix a
+# file twice (mtimes can be coarse), so a file is read and checked again right
+# before it's fixed, and its entry then says it's been fixed.
+
+MAX_CACHED_VERDICTS = 100000
+
+StatKey = Tuple[int, int, int, int]
+
+
+def stat_key(path: str) -> IO_[StatKey]:
+	st = os.stat(path)
+	return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class VerdictCache:
+	""" path -> (stat key, should_fix, reasons), least recently used dropped first """
+
+	def __init__(self, max_entries: int = MAX_CACHED_VERDICTS):
+		self.entries = OrderedDict()
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+
+	def get(self, path: str, key: StatKey) -> Optional[Tuple[bool, List[str]]]:
+		with self.lock:
+			cached = self.entries.get(path)
+			if cached is None or cached[0] != key:
+				return None
+			self.entries.move_to_end(path)
+			return cached[1:]
+
+	def put(self, path: str, key: StatKey, should_fix: bool, reasons: List[str]) -> None:
+		with self.lock:
+			self.entries[path] = (key, should_fix, reasons)
+			self.entries.move_to_end(path)
+			if len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+
+
+class FixService:
+	""" What the server does with requests, without the socket part. """
+
+	def __init__(self, options: Dict[str, Any]):
+		self.options = options
+		self.cache = VerdictCache()
+		# backups and writes go one at a time - the undo journal isn't thread-safe,
+		# and two requests for the same file must not both fix it
+		self.write_lock = threading.Lock()
+		self.n_requests = 0
+		self.stop_requested = threading.Event()
+
+
+	def classify(self, path: str) -> IO_[Tuple[StatKey, bool, List[str], Optional[str], bool]]:
+		""" (stat key, should fix, reasons, text if it was read, whether the verdict was cached) """
+		key = stat_key(path)
+		cached = self.cache.get(path, key)
+		if cached is not None:
+			should_fix, reasons = cached
+			return (key, should_fix, reasons, None, True)
+
+		if not IS_SUBTITLE_FILE.pred(path):
+			# not read - it can be a video
+			should_fix, reasons = file_has_properties_detailed(
+									path, [IS_SUBTITLE_FILE], self.options['show_file_processing_reasons'])
+			text = None
+		else:
+			with open(path, mode='rb') as file:
+				text = file.read().decode('utf-8-sig')
+			should_fix, reasons = file_has_properties_detailed(
+									path, [IS_SUBTITLE_FILE, text_prop_for(text)],
+									self.options['show_file_processing_reasons'])
+		self.cache.put(path, key, should_fix, reasons)
+		return (key, should_fix, reasons, text, False)
+
+
+	def scan(self, path: str) -> IO_[Dict[str, Any]]:
+		_, should_fix, reasons, _, cached = self.classify(path)
+		return {'ok': True, 'should_fix': should_fix, 'reasons': reasons, 'cached': cached}
+
+
+	def fix(self, path: str) -> IO_[Dict[str, Any]]:
+		key, should_fix, reasons, text, cached = self.classify(path)
+		n_bytes = 0
+		if should_fix:
+			with self.write_lock:
+				changed = stat_key(path) != key
+				if not changed:
+					# read and checked again under the lock: with coarse mtimes (NFS, older ext4)
+					# a file another request fixed a moment ago can have the same stat key
+					with open(path, mode='rb') as file:
+						text = file.read().decode('utf-8-sig')
+					if IS_MISDECODED_POLISH_TEXT.pred(text):
+						text = fix(text)
+						n_bytes = backup_and_write_fixed(path, text, self.options)
+					else:
+						should_fix = False
+					# the verdict for what's in the file now - a fixed file is never fixed again
+					_, reasons_now = file_has_properties_detailed(
+										path, [IS_SUBTITLE_FILE, text_prop_for(text)],
+										self.options['show_file_processing_reasons'])
+					self.cache.put(path, stat_key(path), False, reasons_now)
+					if not should_fix:
+						reasons = reasons_now
+			if changed:
+				# changed since it was classified - maybe fixed by another request
+				return self.fix(path)
+
+		if should_fix:
+			result = Fixed(path, n_bytes)  # type: FileResult
+		else:
+			result = NotFixed(path)
+		return {'ok': True, 'result': result.get_variant_name(), 'n_bytes': n_bytes,
+				'reasons': reasons, 'cached': cached}
+
+
+	def handle(self, request: Dict[str, Any]) -> IO_[Dict[str, Any]]:
+		self.n_requests += 1
+		op = request.get('op')
+		try:
+			if op == 'fix':
+				return self.fix(_request_path(request))
+			elif op == 'scan':
+				return self.scan(_request_path(request))
+			elif op == 'ping':
+				return {'ok': True, 'pid': os.getpid(), 'n_requests': self.n_requests}
+			elif op == 'stop':
+				self.stop_requested.set()
+				return {'ok': True}
+			else:
+				return {'ok': False, 'error': "unknown op: " + str(op)}
+		except (OSError, UnicodeDecodeError, ValueError) as err:
+			return {'ok': False, 'error': str(err)}
+
+
+def _request_path(request: Dict[str, Any]) -> str:
+	path = request.get('path')
+	if not isinstance(path, str) or not os.path.isabs(path):
+		# the server's working directory has nothing to do with the client's
+		raise ValueError("'path' must be an absolute path")
+	return path
+
+
+
+# === The socket part ===
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+	def handle(self) -> IO_[None]:
+		service = self.server.service
+		for line in self.rfile:
+			start = time.monotonic()
+			try:
+				request = json.loads(line.decode('utf-8'))
+			except ValueError as err:
+				request = None
+				response = {'ok': False, 'error': "invalid request: " + str(err)}
+			else:
+				response = service.handle(request) if isinstance(request, dict) \
+						   else {'ok': False, 'error': "invalid request: not an object"}
+			self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+			if service.options['show_file_processing_reasons'] != NoReasons and isinstance(request, dict):
+				print("{} {} -> {} ({:.2f} ms)".format(
+						request.get('op'), request.get('path', ''),
+						response.get('result', response.get('error', 'ok')),
+						(time.monotonic() - start) * 1000))
+			if service.stop_requested.is_set():
+				threading.Thread(target=self.server.shutdown).start()
+				return
+
+
+
+def serve(socket_path: str, options: Dict[str, Any]) -> IO_[None]:
+	socket_dir = os.path.dirname(os.path.abspath(socket_path))
+	os.makedirs(socket_dir, exist_ok=True)
+	if os.path.exists(socket_path):
+		if _is_listening(socket_path):
+			print("Error: a server is already running on " + socket_path)
+			return
+		os.remove(socket_path)  # left behind by a server that didn't stop cleanly
+
+	old_umask = os.umask(0o077)  # only this user can talk to the server
+	try:
+		server = _Server(socket_path, _RequestHandler)
+	finally:
+		os.umask(old_umask)
+	server.service = FixService(options)
+
+	# `shutdown` waits for `serve_forever` to return, so it can't run on this thread
+	stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+	signal.signal(signal.SIGTERM, stop)
+
+	print("Ready. Stop with Ctrl-C, SIGTERM or `npfc.py --stop`.")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(socket_path)
+		print("Stopped after {} requests.".format(server.service.n_requests))
+
+
+def _is_listening(socket_path: str) -> IO_[bool]:
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+		return True
+	except OSError:
+		return False
+	finally:
+		sock.close()
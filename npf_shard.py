@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import socket
+import hashlib
+from typing import List, Optional, Sequence, Tuple
+
+try:
+	import fcntl
+except ImportError:  # not on Windows - leases there only expire, they're never locked
+	fcntl = None
+
+from npf_utils import (
+	FileEntry,
+	IO_,
+)
+
+
+# === Several nodes on one shared library ===
+
+# `--shard i/N` on N machines (i = 0 .. N-1) splits the library between them:
+# a file belongs to the shard  md5(its path relative to the selected dir) mod N,
+# so every node agrees even if they mount the library in different places.
+#
+# Shards don't overlap, but runs can (two nodes started with the same shard,
+# or with different N). So before a file is checked and rewritten, its node
+# takes a lease: it creates  FILE.npf-lease  with O_EXCL (atomic on NFS too)
+# and holds an fcntl lock on it until it's done.
+# Another node that finds the lease file skips the file - unless the lease is
+# stale: not locked by anyone (the holder died) and older than the TTL
+# (for filesystems where fcntl locks don't reach other nodes).
+
+LEASE_SUFFIX = '.npf-lease'
+
+
+def shard_of(relative_path: str, n_shards: int) -> int:
+	digest = hashlib.md5(relative_path.replace(os.sep, '/').encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'big') % n_shards
+
+
+def entries_in_shard(entries: Sequence[FileEntry], root: str, shard: Tuple[int, int]) -> List[FileEntry]:
+	""" also leaves out other nodes' lease files """
+	index, n_shards = shard
+	return [ entry for entry in entries
+			 if LEASE_SUFFIX not in os.path.basename(entry.path)
+			 and shard_of(os.path.relpath(entry.path, root), n_shards) == index ]
+
+
+
+class FileLease:
+	"""
+		with FileLease(filename, ttl) as lease:
+			if lease.acquired:
+				...
+	"""
+
+	def __init__(self, filename: str, ttl: float):
+		self.filename = filename
+		self.lease_path = filename + LEASE_SUFFIX
+		self.ttl = ttl
+		self.fd = None  # type: Optional[int]
+
+	@property
+	def acquired(self) -> bool:
+		return self.fd is not None
+
+	def __enter__(self) -> 'FileLease':
+		if not self._try_create() and self._break_if_stale():
+			self._try_create()
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.release()
+
+
+	def _try_create(self) -> IO_[bool]:
+		try:
+			fd = os.open(self.lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+		except FileExistsError:
+			return False
+		if fcntl is not None:
+			fcntl.lockf(fd, fcntl.LOCK_EX)  # nobody else has it open yet, doesn't block
+		holder = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+		os.write(fd, json.dumps(holder).encode('utf-8'))
+		self.fd = fd
+		return True
+
+	def _break_if_stale(self) -> IO_[bool]:
+		""" removes the lease file if its holder is gone. True if it was removed. """
+		try:
+			fd = os.open(self.lease_path, os.O_RDWR)
+		except FileNotFoundError:
+			return True  # released in the meantime
+		try:
+			if fcntl is not None:
+				try:
+					fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except OSError:
+					return False  # locked - the holder is alive
+			st = os.fstat(fd)
+			if time.time() - st.st_mtime < self.ttl:
+				return False
+			try:
+				if os.stat(self.lease_path).st_ino != st.st_ino:
+					return False  # broken and taken again by another node meanwhile
+			except FileNotFoundError:
+				return False
+			# only one of the nodes breaking it at the same time gets to rename it
+			stale_path = '{}.stale-{}-{}'.format(self.lease_path, socket.gethostname(), os.getpid())
+			try:
+				os.rename(self.lease_path, stale_path)
+			except FileNotFoundError:
+				return False
+			os.remove(stale_path)
+			return True
+		finally:
+			os.close(fd)
+
+	def release(self) -> IO_[None]:
+		if self.fd is not None:
+			# removed before unlocking, so a waiting node can't see an unlocked live lease
+			os.remove(self.lease_path)
+			os.close(self.fd)
+			self.fd = None
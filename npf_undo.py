@@ -0,0 +1,311 @@
+import os
+import json
+import stat
+import time
+import zlib
+import shutil
+import hashlib
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+try:
+	import fcntl
+except ImportError:  # not on Windows - no reflinks there
+	fcntl = None
+
+from npf_utils import (
+	WINDOWS_DEFAULT,
+	EASTERN_EUROPE,
+	write_fixed,
+	indent,
+	IO_,
+)
+
+
+# === Undo journal ===
+
+# Instead of a full .bak copy next to every fixed file, each run gets one
+# append-only journal in  <journal root>/<run id>/journal.
+# Each record is a JSON header line, followed by `payload_size` bytes.
+# The original contents are stored in the cheapest way that works:
+#
+#   'reverse'  nothing at all - `fix` can be undone with `unfix` for most texts.
+#              Only used if unfixing the fixed text gives back the exact original bytes.
+#   'reflink'  a copy-on-write clone of the original in the run dir (btrfs, xfs...)
+#   'link'     a hard link to the original in the run dir. The original inode
+#              must stay untouched, so the fixed file is written as a new file -
+#              only for plain files: not a symlink (the link would replace it,
+#              leaving its target unfixed), not hard linked elsewhere (the other
+#              names would keep the old contents), and owned by us (a new file
+#              would be too).
+#   'zlib'     the original, compressed, as the record's payload.
+#
+# `--undo RUN_ID` restores every file of the run in one pass - in place,
+# unless the record says the fixed file was written as a new file.
+
+UTF8_BOM = b'\xef\xbb\xbf'
+
+FICLONE = 0x40049409  # linux/fs.h
+
+
+def unfix(text: str) -> str:
+	""" the inverse of `fix`. Raises UnicodeError if there isn't one for `text`. """
+	return text.encode(EASTERN_EUROPE).decode(WINDOWS_DEFAULT)
+
+
+def sha1(data: bytes) -> str:
+	return hashlib.sha1(data).hexdigest()
+
+def fixed_file_bytes(fixed: str) -> bytes:
+	# what `write_fixed` puts in the file
+	return fixed.encode('utf-8-sig')
+
+
+def new_run_id() -> str:
+	return time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid())
+
+
+
+class UndoJournal:
+	"""
+	The undo journal of one run. The run dir is only created
+	when the first file is recorded.
+	"""
+
+	def __init__(self, journal_root: str, run_id: Optional[str] = None):
+		self.run_id = run_id if run_id is not None else new_run_id()
+		self.run_dir = os.path.join(journal_root, self.run_id)
+		self.file = None
+		self.n_records = 0
+
+
+	def record(self, filename: str, fixed: str, new_file: bool = False) -> IO_[bool]:
+		"""
+		Records the current contents of `filename`, which is about to be replaced
+		with `fixed` (`new_file` - by a new file, whatever the backup needs).
+		Returns True if the file must be written as a new file
+		(not modified in place) to keep the backup intact.
+		"""
+		with open(filename, mode='rb') as file:
+			original = file.read()
+		written = fixed_file_bytes(fixed)
+
+		header = {
+			'path': os.path.abspath(filename),
+			'original_sha1': sha1(original),
+			'fixed_sha1': sha1(written),
+		}
+		payload = b''
+		needs_new_file = new_file
+
+		unfixed = _unfixed_bytes(written, has_bom=False)
+		if unfixed is not None and (original == unfixed or original == UTF8_BOM + unfixed):
+			header['method'] = 'reverse'
+			header['original_bom'] = original.startswith(UTF8_BOM)
+
+		elif self._try_reflink(filename, header):
+			header['method'] = 'reflink'
+
+		elif self._try_link(filename, header):
+			header['method'] = 'link'
+			needs_new_file = True
+
+		else:
+			header['method'] = 'zlib'
+			payload = zlib.compress(original)
+
+		header['new_file'] = needs_new_file
+		header['payload_size'] = len(payload)
+		self._append(header, payload)
+		return needs_new_file
+
+
+	def _blob_path(self) -> str:
+		return os.path.join(self.run_dir, 'blob-{}'.format(self.n_records))
+
+	def _try_reflink(self, filename: str, header: Dict[str, Any]) -> IO_[bool]:
+		if fcntl is None:
+			return False
+		self._open()
+		blob = self._blob_path()
+		try:
+			with open(filename, mode='rb') as src, open(blob, mode='wb') as dst:
+				fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+		except OSError:
+			_remove_if_exists(blob)
+			return False
+		header['blob'] = os.path.basename(blob)
+		return True
+
+	def _try_link(self, filename: str, header: Dict[str, Any]) -> IO_[bool]:
+		st = os.lstat(filename)
+		if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 \
+				or (hasattr(os, 'geteuid') and st.st_uid != os.geteuid()):
+			return False  # see 'link' above
+		self._open()
+		blob = self._blob_path()
+		try:
+			os.link(filename, blob)
+		except OSError:  # different filesystem, or no hard links
+			return False
+		header['blob'] = os.path.basename(blob)
+		return True
+
+
+	def _open(self) -> IO_[None]:
+		if self.file is None:
+			os.makedirs(self.run_dir, exist_ok=True)
+			self.file = open(os.path.join(self.run_dir, 'journal'), mode='ab')
+
+	def _append(self, header: Dict[str, Any], payload: bytes) -> IO_[None]:
+		self._open()
+		self.file.write(json.dumps(header).encode('utf-8') + b'\n')
+		self.file.write(payload)
+		self.file.flush()
+		self.n_records += 1
+
+	def sync(self) -> IO_[None]:
+		""" makes the records so far survive a crash """
+		if self.file is not None:
+			os.fsync(self.file.fileno())
+
+	def close(self) -> IO_[None]:
+		if self.file is not None:
+			os.fsync(self.file.fileno())
+			self.file.close()
+			self.file = None
+
+
+
+def _unfixed_bytes(written: bytes, has_bom: bool) -> Optional[bytes]:
+	"""
+	The original bytes, reconstructed from the fixed file's bytes
+	(the fixed file always has a BOM, the original might not have had one).
+	"""
+	try:
+		unfixed = unfix(written.decode('utf-8-sig')).encode('utf-8')
+	except UnicodeError:
+		return None
+	return UTF8_BOM + unfixed if has_bom else unfixed
+
+
+def _remove_if_exists(path: str) -> IO_[None]:
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+TMP_SUFFIX = '.npf-tmp'
+
+def write_new_file(filename: str, data: bytes, durable: bool = False) -> IO_[None]:
+	"""
+	replaces `filename` with a new file (a new inode), keeping its permissions.
+	The file has either its old or its new contents, never a mix.
+	`durable` - the new contents are on the disk before the file is replaced.
+	"""
+	tmp_filename = filename + TMP_SUFFIX
+	with open(tmp_filename, mode='wb') as file:
+		file.write(data)
+		if durable:
+			file.flush()
+			os.fsync(file.fileno())
+	shutil.copymode(filename, tmp_filename)
+	os.replace(tmp_filename, filename)
+
+
+def backup_file(filename: str, fixed: str, options: Dict[str, Any], new_file: bool = False) -> IO_[bool]:
+	"""
+	Backs `filename` up before it's overwritten with `fixed`, the way `options` say
+	(`new_file` - the caller replaces it with a new file anyway).
+	Returns True if the file must be written as a new file, not in place.
+	"""
+	if not options['backup']:
+		return False
+	journal = options['undo_journal']
+	if journal is None:
+		shutil.copy(filename, filename+'.bak')
+		return False
+	return journal.record(filename, fixed, new_file)
+
+
+def backup_and_write_fixed(filename: str, fixed: str, options: Dict[str, Any]) -> IO_[int]:
+	return write_backed_up_fixed(filename, fixed, backup_file(filename, fixed, options))
+
+
+def write_backed_up_fixed(filename: str, fixed: str, as_new_file: bool) -> IO_[int]:
+	""" writes `fixed` after `backup_file`, which says whether it must be `as_new_file` """
+	if as_new_file:
+		write_new_file(filename, fixed_file_bytes(fixed))
+		return len(fixed)
+	return write_fixed(filename, fixed)
+
+
+
+# === Undoing a run ===
+
+def read_journal(run_dir: str) -> IO_[Iterator[Tuple[Dict[str, Any], bytes]]]:
+	with open(os.path.join(run_dir, 'journal'), mode='rb') as file:
+		while True:
+			line = file.readline()
+			if not line.endswith(b'\n'):
+				return  # end of journal, or a record cut short by a crash
+			header = json.loads(line.decode('utf-8'))
+			payload = file.read(header['payload_size'])
+			if len(payload) != header['payload_size']:
+				return
+			yield (header, payload)
+
+
+def restore_original(header: Dict[str, Any], payload: bytes, run_dir: str) -> IO_[None]:
+	""" Restores one file. Raises ValueError if it can't be done safely. """
+	path = header['path']
+	with open(path, mode='rb') as file:
+		current = file.read()
+
+	if sha1(current) != header['fixed_sha1']:
+		raise ValueError("file was changed after it was fixed, not restoring")
+
+	method = header['method']
+	if method == 'reverse':
+		original = _unfixed_bytes(current, header['original_bom'])
+	elif method in ('reflink', 'link'):
+		with open(os.path.join(run_dir, header['blob']), mode='rb') as blob:
+			original = blob.read()
+	elif method == 'zlib':
+		original = zlib.decompress(payload)
+	else:
+		raise ValueError("unknown backup method: " + str(method))
+
+	if original is None or sha1(original) != header['original_sha1']:
+		raise ValueError("backup doesn't match the original file")
+
+	if header.get('new_file', True):
+		# back to a new file too - the current one may be hard linked to other fixed copies
+		write_new_file(path, original)
+	else:
+		# in place, like the fix - keeps symlinks, hard links, the owner...
+		with open(path, mode='wb') as file:
+			file.write(original)
+
+
+def undo_run(run_id: str, journal_root: str) -> IO_[bool]:
+	run_dir = os.path.join(journal_root, run_id)
+	if not os.path.isfile(os.path.join(run_dir, 'journal')):
+		print("Error: no undo journal for run " + run_id)
+		return False
+
+	# newest first, so a file fixed twice ends up with its oldest contents
+	records = list(read_journal(run_dir))
+	n_failed = 0
+	for (header, payload) in reversed(records):
+		print(header['path'])
+		try:
+			restore_original(header, payload, run_dir)
+			print(indent("restored", 4))
+		except (OSError, ValueError) as err:
+			n_failed += 1
+			print(indent("Error: " + str(err), 4))
+
+	print()
+	print("Restored {} of {} files.".format(len(records) - n_failed, len(records)))
+	return n_failed == 0
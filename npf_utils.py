@@ -1,12 +1,13 @@
 import os # getcwd
 		  # os.path - exists, isdir, isfile
-from typing import Any, Tuple, Sequence, Dict, Generic, TypeVar
+from typing import Any, Tuple, Sequence, List, Dict, Generic, TypeVar
 A = TypeVar('A')
 class IO_(Generic[A]):
 	pass
 
 from collections import namedtuple
-from functools import partial
+
+from uniontype import union
 # from either import Either, Left, right
 
 
@@ -25,6 +26,16 @@ misdecoded_polish_chars_no_dup = misdecoded_polish_chars - polish_chars # remove
 
 
 
+def fix_unsafe(text: str) -> str:
+	return text.encode(WINDOWS_DEFAULT).decode(EASTERN_EUROPE)
+
+def fix(text: str) -> str:
+	return text \
+			.encode(WINDOWS_DEFAULT, errors='replace') \
+			.decode(EASTERN_EUROPE, errors='replace')
+
+
+
 
 def impossible(error_text):
 	raise Exception("Internal error: " + error_text)
@@ -77,6 +88,13 @@ def file_contents(filename: str) -> IO_[str]:
 	with open(filename, mode='r', encoding='utf-8-sig') as file:
 		return file.read()
 
+def write_fixed(filename: str, fixed: str) -> IO_[int]:
+	# overwrites the file in place, same as reading it in 'r+' mode and seeking back to 0
+	with open(filename, mode='r+', encoding='utf-8-sig') as file:
+		n_written = file.write(fixed)
+		file.truncate()  # the fixed text can be shorter than the original
+		return n_written
+
 def file_ext(filename: str) -> str:
 	name, dot_ext = os.path.splitext(filename)
 	return dot_ext[1:]
@@ -125,6 +143,24 @@ IS_SUBTITLE_FILE =  FileProperty(
 )
 
 SHOULD_BE_FIXED_props = [IS_SUBTITLE_FILE, IS_MISDECODED_POLISH_FILE]
+
+# what happened to a processed file
+FileResult, \
+	Fixed, \
+	NotFixed, \
+	Failed, \
+= union(
+	'FileResult', [
+		('Fixed',    [('filename', str), ('n_bytes', int)]),
+		('NotFixed', [('filename', str)]),
+		('Failed',   [('filename', str), ('error', str)]),
+	],
+	flat=True
+  )
+
+# properties that only depend on the file's contents, not its name -
+# their results can be shared between files with identical contents
+content_file_props = [IS_MISDECODED_POLISH_FILE]
 # def file_property_and(prop1: FileProperty, prop2: FileProperty) -> FileProperty:
 # 	return FileProperty(
 # 		prop1.name + ' and ' + prop2.name,
@@ -178,12 +214,156 @@ def file_has_properties_detailed(filename: str, props: Sequence[FileProperty], r
 default_cmdline_options = {
 	'verbosity': 2,
 	'backup': True,
+	'recursive': False,
+	'dedup': False,
+	'hardlink_duplicates': False,
+	'workers': 1,
+	'memory_budget': 256,  # MB
+	'audit': False,
+	'detect_engine': 'python',
+	'batch_size': 1000,
+	'incremental': False,
+	'backup_method': 'journal',
+	'io_order': 'listing',
+	'read_ahead': 4,
+	'benchmark_io': False,
+	'progress': False,
+	'require_video': False,
+	'adaptive': False,
+	'verify': False,
+	'to_srt': False,
+	'fps': 0.0,  # 0 - from the file, or npf_convert.DEFAULT_FPS
+	'pair_videos': False,
+	'shard': None,  # (i, N) from --shard i/N, None - the whole library
+	'lease_ttl': 60,  # seconds
+	'checkpoint': False,  # fixed files are replaced by new ones, see npf_checkpoint
+	'resume': False,
+}
+
+backup_methods = ['journal', 'copy']
+io_orders = ['listing', 'inode', 'extent']
+
+# where npf keeps its state between runs
+npf_data_dir = os.path.join(os.path.expanduser('~'), '.npf')
+
+# where `npf.py --serve` listens (npfc.py has its own copy, to avoid importing this module)
+default_socket_path = os.path.join(npf_data_dir, 'npf.sock')
+
+detection_engines = ['python', 'numpy']
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+	"""
+	'1/4' -> (1, 4)
+	Raises ValueError for anything else than  i/N  with 0 <= i < N.
+	"""
+	index_s, slash, n_shards_s = shard.partition('/')
+	if slash == '':
+		raise ValueError("shard must look like i/N, e.g. 0/4: " + shard)
+	index, n_shards = int(index_s), int(n_shards_s)
+	if not 0 <= index < n_shards:
+		raise ValueError("shard index must be from 0 to N-1: " + shard)
+	return (index, n_shards)
+
+# switch name -> type of its argument. `bool` switches take no argument:
+#   --dedup  sets 'dedup' to True,  --no-dedup  sets it to False
+cmdline_switch_types = {
+	'verbosity': int,
+	'backup': bool,
+	'recursive': bool,
+	'dedup': bool,
+	'hardlink_duplicates': bool,
+	'workers': int,
+	'memory_budget': int,
+	'audit': bool,
+	'detect_engine': str,
+	'batch_size': int,
+	'incremental': bool,
+	'backup_method': str,
+	'undo': str,
+	'serve': bool,
+	'socket': str,
+	'io_order': str,
+	'read_ahead': int,
+	'benchmark_io': bool,
+	'progress': bool,
+	'require_video': bool,
+	'adaptive': bool,
+	'verify': bool,
+	'to_srt': bool,
+	'fps': float,
+	'pair_videos': bool,
+	'shard': parse_shard,
+	'lease_ttl': int,
+	'checkpoint': bool,
+	'resume': bool,
 }
 
+short_switch_to_switch = {
+	'V': 'verbosity',
+	'j': 'workers',
+	'b': 'backup',
+	'r': 'recursive',
+}
+
+
+def split_cmdline_args(args: Sequence[str]) -> Tuple[Dict[str, Any], List[str]]:
+	"""
+	Separates switches from positional args.
+	['--verbosity', '1', '-r', '--no-backup', 'Subs']
+	   -> ({'verbosity': 1, 'recursive': True, 'backup': False}, ['Subs'])
+	Raises ValueError on unknown switches and bad switch arguments.
+	"""
+	switches = {}
+	positional_args = []
+
+	args = list(args)
+	while len(args) > 0:
+		arg = args.pop(0)
+
+		if arg.startswith('--') and len(arg) > 2:
+			name, has_value, value = arg[2:].partition('=')
+			name = name.replace('-', '_')
+		elif arg.startswith('-') and len(arg) == 2 and arg[1] in short_switch_to_switch:
+			name, has_value, value = short_switch_to_switch[arg[1]], '', ''
+		else:
+			positional_args.append(arg)
+			continue
+
+		value_is_negated = False
+		if name not in cmdline_switch_types and name.startswith('no_'):
+			name = name[len('no_'):]
+			value_is_negated = True
+
+		if name not in cmdline_switch_types:
+			raise ValueError("unknown switch: " + arg)
+
+		switch_type = cmdline_switch_types[name]
+
+		if switch_type == bool:
+			if has_value:
+				raise ValueError("switch {} takes no arguments".format(arg))
+			switches[name] = not value_is_negated
+
+		else:
+			if value_is_negated:
+				raise ValueError("unknown switch: " + arg)
+			if not has_value:
+				if len(args) == 0:
+					raise ValueError("switch {} needs an argument".format(arg))
+				value = args.pop(0)
+			try:
+				switches[name] = switch_type(value)
+			except ValueError:
+				raise ValueError("invalid argument for {}: {}".format(arg, value))
+
+	return (switches, positional_args)
+
+
 # opts_mapping = {
 # 	OptionVerbose: {'file_property_reporting': AllReasons},
 # } 
 def cmdline_options_to_internal_options(cmdline_options: Dict[str, Any]) -> Dict[str, Any]:
+	""" Raises ValueError on invalid option values. """
 	opts = {}
 	assert 'verbosity' in cmdline_options
 	verbosity = cmdline_options['verbosity']
@@ -194,17 +374,144 @@ def cmdline_options_to_internal_options(cmdline_options: Dict[str, Any]) -> Dict
 	elif verbosity == 2:
 		opts['show_file_processing_reasons'] = AllReasons
 	else:
-		impossible("unknown verbosity: " + str(cmdline_options['verbosity']))
+		raise ValueError("verbosity must be 0, 1 or 2: " + str(verbosity))
 
 	assert 'backup' in cmdline_options
 	opts['backup'] = cmdline_options['backup']
 
+	assert 'recursive' in cmdline_options
+	opts['recursive'] = cmdline_options['recursive']
+
+	assert 'dedup' in cmdline_options
+	assert 'hardlink_duplicates' in cmdline_options
+	opts['dedup'] = cmdline_options['dedup'] or cmdline_options['hardlink_duplicates']
+	opts['hardlink_duplicates'] = cmdline_options['hardlink_duplicates']
+
+	assert 'workers' in cmdline_options
+	if cmdline_options['workers'] <= 0:
+		raise ValueError("workers must be positive: " + str(cmdline_options['workers']))
+	opts['workers'] = cmdline_options['workers']
+
+	assert 'memory_budget' in cmdline_options
+	if cmdline_options['memory_budget'] <= 0:
+		raise ValueError("memory_budget must be positive: " + str(cmdline_options['memory_budget']))
+	opts['memory_budget'] = cmdline_options['memory_budget']
+
+	assert 'audit' in cmdline_options
+	opts['audit'] = cmdline_options['audit']
+
+	assert 'detect_engine' in cmdline_options
+	if cmdline_options['detect_engine'] not in detection_engines:
+		raise ValueError("detect_engine must be one of: " + str.join(', ', detection_engines))
+	opts['detect_engine'] = cmdline_options['detect_engine']
+
+	assert 'batch_size' in cmdline_options
+	if cmdline_options['batch_size'] <= 0:
+		raise ValueError("batch_size must be positive: " + str(cmdline_options['batch_size']))
+	opts['batch_size'] = cmdline_options['batch_size']
+
+	assert 'incremental' in cmdline_options
+	opts['incremental'] = cmdline_options['incremental']
+	opts['incremental_state_dir'] = os.path.join(npf_data_dir, 'incremental')
+
+	assert 'backup_method' in cmdline_options
+	if cmdline_options['backup_method'] not in backup_methods:
+		raise ValueError("backup_method must be one of: " + str.join(', ', backup_methods))
+	opts['backup_method'] = cmdline_options['backup_method']
+	opts['undo_journal_root'] = os.path.join(npf_data_dir, 'undo')
+	opts['undo_journal'] = None  # opened by `main` for the run
+
+	assert 'io_order' in cmdline_options
+	if cmdline_options['io_order'] not in io_orders:
+		raise ValueError("io_order must be one of: " + str.join(', ', io_orders))
+	opts['io_order'] = cmdline_options['io_order']
+
+	assert 'read_ahead' in cmdline_options
+	if cmdline_options['read_ahead'] < 0:
+		raise ValueError("read_ahead can't be negative: " + str(cmdline_options['read_ahead']))
+	opts['read_ahead'] = cmdline_options['read_ahead']
+
+	assert 'benchmark_io' in cmdline_options
+	opts['benchmark_io'] = cmdline_options['benchmark_io']
+
+	assert 'progress' in cmdline_options
+	opts['progress'] = cmdline_options['progress']
+
+	assert 'require_video' in cmdline_options
+	opts['require_video'] = cmdline_options['require_video']
+	opts['extra_file_props'] = []  # filled in by `main`, e.g. with HAS_ACCOMPANYING_VIDEO
+
+	assert 'adaptive' in cmdline_options
+	assert 'verify' in cmdline_options
+	if cmdline_options['verify'] and not cmdline_options['adaptive']:
+		raise ValueError("verify only works with adaptive")
+	opts['adaptive'] = cmdline_options['adaptive']
+	opts['verify'] = cmdline_options['verify']
+	opts['should_be_fixed_props'] = SHOULD_BE_FIXED_props  # replaced by `main` for adaptive detection
+	opts['adaptive_detector'] = None  # set by `main` for adaptive detection
+
+	assert 'to_srt' in cmdline_options
+	opts['to_srt'] = cmdline_options['to_srt']
+
+	assert 'fps' in cmdline_options
+	if cmdline_options['fps'] < 0:
+		raise ValueError("fps can't be negative: " + str(cmdline_options['fps']))
+	opts['fps'] = cmdline_options['fps'] if cmdline_options['fps'] > 0 else None
+
+	assert 'pair_videos' in cmdline_options
+	opts['pair_videos'] = cmdline_options['pair_videos']
+	opts['video_hash_cache_path'] = os.path.join(npf_data_dir, 'video_hashes.json')
+
+	assert 'shard' in cmdline_options
+	opts['shard'] = cmdline_options['shard']
+
+	assert 'lease_ttl' in cmdline_options
+	if cmdline_options['lease_ttl'] <= 0:
+		raise ValueError("lease_ttl must be positive: " + str(cmdline_options['lease_ttl']))
+	opts['lease_ttl'] = cmdline_options['lease_ttl']
+
+	assert 'checkpoint' in cmdline_options
+	assert 'resume' in cmdline_options
+	if cmdline_options['resume'] and not cmdline_options['checkpoint']:
+		raise ValueError("resume needs checkpoint")
+	opts['checkpoint'] = cmdline_options['checkpoint']
+	opts['resume'] = cmdline_options['resume']
+	opts['runs_dir'] = os.path.join(npf_data_dir, 'runs')
+	opts['run_journal'] = None  # opened by `main` for directory runs
+
 	return opts
 
 
 
 
 
+# === Listing files ===
+
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'inode', 'mtime'])
+
+def list_dir_files(dirname: str, recursive: bool) -> IO_[List[FileEntry]]:
+	"""
+	Lists the files in `dirname` in `os.listdir` order (and, if `recursive`,
+	the files in its subdirectories after them). Sizes and inodes come from
+	the same scandir pass, so callers don't have to stat the files again.
+	Symlinked directories aren't followed - they can loop, and a tree linked
+	from inside the library would be listed twice.
+	"""
+	files = []
+	subdirs = []
+	for entry in os.scandir(dirname):
+		if entry.is_file():
+			st = entry.stat()
+			files.append(FileEntry(entry.path, st.st_size, st.st_ino, st.st_mtime))
+		elif recursive and entry.is_dir(follow_symlinks=False):
+			subdirs.append(entry.path)
+
+	for subdir in subdirs:
+		files.extend(list_dir_files(subdir, recursive))
+
+	return files
+
+
 # def find_files_to_fix(dirname: str) -> Sequence[str]:
 # 	dir_contents = os.listdir(dirname)
 # 	return list(lambda filename: filter(SHOULD_BE_FIXED.pred, dir_contents))
@@ -223,11 +530,13 @@ def has_accompanying_video_in_dir(filename: str, dirname: str) -> bool:
 	return any( os.path.exists(os.path.join(dirname, episode_name + '.' + format))
 				for format in video_exts )
 
+# `video_index` is a npf_episodes.VideoIndex, built once for the whole library
 get_HAS_ACCOMPANYING_VIDEO = \
-	lambda dirname: \
+	lambda video_index: \
 		FileProperty(
-			'has_accompanying_video',
-			partial(has_accompanying_video_in_dir, dirname=dirname)
+			'has an accompanying video',
+			'has no accompanying video',
+			lambda filename: video_index.video_for(filename) is not None
 		)
 
 
@@ -0,0 +1,158 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from npf_utils import (
+	FileEntry,
+	IS_SUBTITLE_FILE,
+	video_exts,
+	file_ext,
+	indent,
+	IO_,
+)
+from npf_episodes import VideoIndex
+
+
+# === napiprojekt video hashes ===
+
+# napiprojekt identifies a video by the MD5 of its first 10 MB, and its
+# subtitles are often saved as '<hash>.txt'.
+# Only that prefix is mapped into memory, and md5 releases the GIL for large
+# buffers, so several videos are hashed at once on a thread pool.
+# Hashes are cached in  ~/.npf/video_hashes.json  by device, inode, size and
+# mtime - re-pairing a library after new downloads only hashes the new videos.
+
+NAPI_PREFIX_BYTES = 10 * 1024 * 1024
+
+DEFAULT_HASH_THREADS = 4
+
+
+def napi_hash(filename: str) -> IO_[str]:
+	with open(filename, mode='rb') as file:
+		n_bytes = min(os.fstat(file.fileno()).st_size, NAPI_PREFIX_BYTES)
+		if n_bytes == 0:
+			return hashlib.md5(b'').hexdigest()  # mmap can't map an empty file
+		with mmap.mmap(file.fileno(), n_bytes, access=mmap.ACCESS_READ) as prefix:
+			return hashlib.md5(prefix).hexdigest()
+
+
+def cache_key(filename: str) -> IO_[str]:
+	st = os.stat(filename)
+	return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+
+class VideoHashCache:
+	""" cache key -> napi hash, kept in a JSON file """
+
+	def __init__(self, path: str):
+		self.path = path
+		self.hashes = {}  # type: Dict[str, str]
+		self.changed = False
+		self.lock = threading.Lock()
+		try:
+			with open(path, mode='r', encoding='utf-8') as file:
+				self.hashes = json.load(file)
+		except (OSError, ValueError):  # no cache yet, or a broken one - start over
+			pass
+
+	def get(self, key: str) -> Optional[str]:
+		return self.hashes.get(key)
+
+	def put(self, key: str, napi_hash: str) -> None:
+		with self.lock:
+			self.hashes[key] = napi_hash
+			self.changed = True
+
+	def save(self) -> IO_[None]:
+		if not self.changed:
+			return
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, mode='w', encoding='utf-8') as file:
+			json.dump(self.hashes, file)
+		os.replace(tmp_path, self.path)
+		self.changed = False
+
+
+
+def hash_videos(filenames: Sequence[str], cache: VideoHashCache, n_threads: int) -> IO_[Tuple[Dict[str, str], int]]:
+	"""
+	(filename -> napi hash, how many files were hashed).
+	Only the files that aren't in `cache` are read.
+	"""
+	hashes = {}
+	to_hash = []
+	for filename in filenames:
+		key = cache_key(filename)
+		cached = cache.get(key)
+		if cached is not None:
+			hashes[filename] = cached
+		else:
+			to_hash.append((filename, key))
+
+	def hash_one(filename_and_key):
+		filename, key = filename_and_key
+		digest = napi_hash(filename)
+		cache.put(key, digest)
+		return (filename, digest)
+
+	with ThreadPoolExecutor(max_workers=n_threads) as pool:
+		hashes.update(pool.map(hash_one, to_hash))
+	return (hashes, len(to_hash))
+
+
+
+# === Pairing ===
+
+def pair_videos(entries: Sequence[FileEntry], options: Dict[str, Any]) -> IO_[None]:
+	"""
+	Lists every video with its napi hash and its subtitles - found either by
+	the napiprojekt name ('<hash>.txt') or by the episode name.
+	"""
+	videos = [entry.path for entry in entries if file_ext(entry.path).lower() in video_exts]
+	subtitles = [entry.path for entry in entries if IS_SUBTITLE_FILE.pred(entry.path)]
+
+	cache = VideoHashCache(options['video_hash_cache_path'])
+	n_threads = options['workers'] if options['workers'] > 1 else DEFAULT_HASH_THREADS
+	start = time.monotonic()
+	hashes, n_hashed = hash_videos(videos, cache, n_threads)
+	seconds = time.monotonic() - start
+	cache.save()
+
+	subtitles_by_stem = defaultdict(list)
+	for subtitle in subtitles:
+		stem, _ = os.path.splitext(os.path.basename(subtitle))
+		subtitles_by_stem[stem.lower()].append(subtitle)
+
+	video_index = VideoIndex(videos)
+	subtitles_by_video = defaultdict(list)
+	for subtitle in subtitles:
+		video = video_index.video_for(subtitle)
+		if video is not None:
+			subtitles_by_video[video].append(subtitle)
+
+	n_paired = 0
+	for video in videos:
+		print(video)
+		print(indent("napi hash: " + hashes[video], 4))
+		by_hash = subtitles_by_stem.get(hashes[video], [])
+		by_name = [subtitle for subtitle in subtitles_by_video.get(video, []) if subtitle not in by_hash]
+		for subtitle in by_hash:
+			print(indent("subtitle (by hash): " + subtitle, 4))
+		for subtitle in by_name:
+			print(indent("subtitle (by name): " + subtitle, 4))
+		if len(by_hash) + len(by_name) == 0:
+			print(indent("no subtitles", 4))
+		else:
+			n_paired += 1
+
+	print()
+	print("Videos: {}, with subtitles: {}".format(len(videos), n_paired))
+	print("Hashed {} videos in {:.2f}s ({} from the cache)".format(n_hashed, seconds, len(videos) - n_hashed))
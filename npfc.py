@@ -0,0 +1,110 @@
+"""
+Client for a running `npf.py --serve`, for hooks that fix one file at a time.
+
+	npfc.py [--scan] [--socket PATH] FILE...
+	npfc.py [--socket PATH] --ping | --stop
+
+Only imports the standard library, so it starts quickly. If no server is
+running, falls back to running `npf.py FILE` for each file.
+Exits with 1 if anything failed.
+"""
+import os
+import sys
+import json
+import socket
+import subprocess
+
+# same as `default_socket_path` in npf_utils
+DEFAULT_SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.npf', 'npf.sock')
+
+NPF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'npf.py')
+
+
+def parse_args(args):
+	op, socket_path, paths = 'fix', DEFAULT_SOCKET_PATH, []
+	args = list(args)
+	while len(args) > 0:
+		arg = args.pop(0)
+		if arg == '--scan':
+			op = 'scan'
+		elif arg in ('--ping', '--stop'):
+			op = arg[2:]
+		elif arg == '--socket' and len(args) > 0:
+			socket_path = args.pop(0)
+		elif arg.startswith('--socket='):
+			socket_path = arg[len('--socket='):]
+		elif arg.startswith('--'):
+			raise ValueError("unknown switch: " + arg)
+		else:
+			paths.append(os.path.abspath(arg))
+	if op in ('fix', 'scan') and len(paths) == 0:
+		raise ValueError("no files given")
+	return op, socket_path, paths
+
+
+def requests_for(op, paths):
+	if op in ('fix', 'scan'):
+		return [{'op': op, 'path': path} for path in paths]
+	return [{'op': op}]
+
+
+def send_all(socket_path, requests):
+	""" sends all the requests over one connection, yields the responses """
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(socket_path)
+	with sock, sock.makefile('rwb') as conn:
+		for request in requests:
+			conn.write(json.dumps(request).encode('utf-8') + b'\n')
+			conn.flush()
+			line = conn.readline()
+			if not line:
+				raise ConnectionError("server closed the connection")
+			yield json.loads(line.decode('utf-8'))
+
+
+def describe(request, response):
+	if not response['ok']:
+		return "Error: {} {}".format(request.get('path', ''), response['error']).rstrip()
+	op = request['op']
+	if op == 'fix':
+		return "{} {}".format(response['result'], request['path'])
+	elif op == 'scan':
+		return "{} {}".format("Should be fixed:" if response['should_fix'] else "OK:", request['path'])
+	elif op == 'ping':
+		return "Server {} is up, {} requests so far".format(response['pid'], response['n_requests'])
+	else:
+		return "Server stopping"
+
+
+def main():
+	try:
+		op, socket_path, paths = parse_args(sys.argv[1:])
+	except ValueError as err:
+		print("Error: " + str(err), file=sys.stderr)
+		print(__doc__.strip(), file=sys.stderr)
+		return 2
+
+	requests = requests_for(op, paths)
+	all_ok = True
+	n_done = 0
+	try:
+		for (request, response) in zip(requests, send_all(socket_path, requests)):
+			print(describe(request, response))
+			all_ok = all_ok and response['ok']
+			n_done += 1
+	except (FileNotFoundError, ConnectionRefusedError):
+		if n_done > 0 or op != 'fix':
+			print("Error: no server on " + socket_path, file=sys.stderr)
+			return 1
+		# no server - do it the slow way
+		for path in paths:
+			all_ok = subprocess.call([sys.executable, NPF_PATH, path]) == 0 and all_ok
+	except (OSError, ValueError) as err:
+		print("Error: " + str(err), file=sys.stderr)
+		return 1
+
+	return 0 if all_ok else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
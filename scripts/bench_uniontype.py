@@ -0,0 +1,85 @@
+"""
+Memory and attribute access benchmarks for `uniontype.union`,
+nested (the default) vs flat (`flat=True`) values.
+
+	python scripts/bench_uniontype.py [N]
+
+Runs on Python 3.8 or older only: typed unions read NamedTuple._field_types,
+which was removed in 3.9. Numbers from a newer interpreter are from a shim
+that puts `_field_types` back, not from uniontype as it is.
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from uniontype import union
+
+
+def make_token_type(flat: bool):
+	return union(
+		'FlatToken' if flat else 'Token', [
+			('ShortSwitchToken', [('letter', str)]),
+			('LongSwitchToken',  [('name',   str)]),
+			('IntToken',         [('value', int)]),
+			('StringToken',      [('value', str)]),
+		],
+		flat=flat
+	)
+
+def make_result_type(flat: bool):
+	return union(
+		'FlatFileResult' if flat else 'FileResult', [
+			('Fixed',    [('filename', str), ('n_bytes', int)]),
+			('NotFixed', [('filename', str)]),
+		],
+		flat=flat
+	)
+
+
+def bytes_per_value(make_values, n: int) -> float:
+	tracemalloc.start()
+	before, _ = tracemalloc.get_traced_memory()
+	values = make_values(n)
+	after, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	assert len(values) == n
+	return (after - before) / n
+
+
+def ns_per_call(stmt, n_loops: int = 200000) -> float:
+	return min(timeit.repeat(stmt, number=n_loops, repeat=5)) / n_loops * 1e9
+
+
+def bench(flat: bool, n: int) -> None:
+	Token, Short, Long, IntToken, StringToken = make_token_type(flat)
+	FileResult, Fixed, NotFixed = make_result_type(flat)
+
+	# strings are shared, so only the union values themselves are measured
+	filename = 'Show.S01E02.txt'
+	token_bytes  = bytes_per_value(lambda n: [IntToken(i) for i in range(n)], n)
+	result_bytes = bytes_per_value(lambda n: [Fixed(filename, i) for i in range(n)], n)
+
+	token  = IntToken(5)
+	result = Fixed(filename, 100)
+	other  = NotFixed(filename)
+
+	print('flat' if flat else 'nested')
+	print('    memory:  IntToken {:6.1f} B/value,  Fixed {:6.1f} B/value'.format(token_bytes, result_bytes))
+	print('    access:  token.value {:6.1f} ns,  result.filename {:6.1f} ns,  result.n_bytes {:6.1f} ns' \
+		  .format(ns_per_call(lambda: token.value),
+				  ns_per_call(lambda: result.filename),
+				  ns_per_call(lambda: result.n_bytes)))
+	print('    methods: is_Fixed() {:6.1f} ns,  as_tuple() {:6.1f} ns,  other.filename {:6.1f} ns' \
+		  .format(ns_per_call(lambda: result.is_Fixed()),
+				  ns_per_call(lambda: result.as_tuple()),
+				  ns_per_call(lambda: other.filename)))
+	print('    construct: Fixed(...) {:6.1f} ns'.format(ns_per_call(lambda: Fixed(filename, 100), 50000)))
+
+
+if __name__ == '__main__':
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	bench(flat=False, n=n)
+	bench(flat=True,  n=n)
@@ -0,0 +1,90 @@
+"""
+Local check of sharded runs: several `npf.py --shard i/N` processes on one
+library (use a tmpfs for realistic timings), plus extra processes running
+the same shards again, so the runs overlap and only the leases keep them apart.
+Checks that every misdecoded file was fixed exactly once.
+
+	python scripts/check_shards.py [N_FILES] [MAX_SHARDS] [DIR]
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from npf_utils import fix
+
+NPF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'npf.py')
+
+MISDECODED_LINE = 'Za¿ó³æ gêœl¹ jaŸñ\n'
+
+
+def make_library(root: str, n_files: int) -> Dict[str, str]:
+	originals = {}
+	for i in range(n_files):
+		dirname = os.path.join(root, 'season {}'.format(i % 10))
+		os.makedirs(dirname, exist_ok=True)
+		path = os.path.join(dirname, 'episode {}.srt'.format(i))
+		text = '1\n00:00:01,000 --> 00:00:02,000\n' + MISDECODED_LINE * 200 + str(i) + '\n'
+		with open(path, mode='w', encoding='utf-8') as file:
+			file.write(text)
+		originals[path] = text
+	return originals
+
+
+def run_shards(root: str, n_shards: int, n_overlapping: int) -> Tuple[float, str]:
+	""" starts all the processes at once, returns (seconds, their output) """
+	env = dict(os.environ, HOME=root)  # undo journals go to <root>/.npf
+	commands = [ [sys.executable, NPF_PATH, '-r', '-V', '0', '--shard', '{}/{}'.format(i, n_shards), root]
+				 for i in list(range(n_shards)) + list(range(n_overlapping)) ]
+	start = time.monotonic()
+	processes = [ subprocess.Popen(command, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+				  for command in commands ]
+	outputs = [process.communicate()[0] for process in processes]
+	seconds = time.monotonic() - start
+	if any(process.returncode != 0 for process in processes):
+		raise RuntimeError("a shard process failed:\n" + str.join('\n', outputs))
+	return (seconds, str.join('\n', outputs))
+
+
+def check(root: str, originals: Dict[str, str], output: str) -> None:
+	fixed_paths = re.findall(r'^Fixing (.*)$', output, re.MULTILINE)
+	double = len(fixed_paths) - len(set(fixed_paths))
+	wrong = []
+	for (path, text) in originals.items():
+		with open(path, mode='r', encoding='utf-8-sig') as file:
+			if file.read() != fix(text):
+				wrong.append(path)
+	leftover_leases = [ name for (_, _, names) in os.walk(root) for name in names if '.npf-lease' in name ]
+
+	assert double == 0, "{} files fixed more than once".format(double)
+	assert len(wrong) == 0, "{} files not fixed correctly, e.g. {}".format(len(wrong), wrong[0])
+	assert len(leftover_leases) == 0, "leases left behind: " + str(leftover_leases[:5])
+
+
+def main():
+	n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	max_shards = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	base_dir = sys.argv[3] if len(sys.argv) > 3 else ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+	for n_shards in range(1, max_shards + 1):
+		# once as intended, for the throughput, and once with every shard run twice
+		for n_overlapping in (0, n_shards):
+			root = tempfile.mkdtemp(prefix='npf-shards-', dir=base_dir)
+			try:
+				originals = make_library(root, n_files)
+				seconds, output = run_shards(root, n_shards, n_overlapping)
+				check(root, originals, output)
+				n_skipped = output.count('leased by another node')
+				print("{} shards + {} overlapping runs: {:.2f}s, {:.0f} files/s, {} skipped as leased - OK" \
+					  .format(n_shards, n_overlapping, seconds, n_files / seconds, n_skipped))
+			finally:
+				shutil.rmtree(root)
+
+if __name__ == '__main__':
+	main()
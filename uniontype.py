@@ -1,6 +1,10 @@
 
+import re
+import sys
+import importlib
 from collections import namedtuple
-from typing import Any, Tuple, List, Callable, Union
+from operator import itemgetter
+from typing import Any, Dict, Tuple, List, Callable, Union
 import typing
 # from functools import partial
 
@@ -11,7 +15,12 @@ Fun = Callable
 
 def untyped_union(
 		type_name: str, variant_specs: List[ Tuple[str, List[str]] ],
-		allow_zero_constructors=False ) -> List[Any]:
+		allow_zero_constructors=False,
+		flat=False,
+		module=None ) -> List[Any]:
+
+	if module is None:
+		module = _caller_module()
 
 	variant_specs = [    (variant_name, [(attr_name, Any) for attr_name in attr_names])
 					 for (variant_name, attr_names)
@@ -19,7 +28,9 @@ def untyped_union(
 
 	return union(type_name, variant_specs,
 				 typecheck=False,
-				 allow_zero_constructors=allow_zero_constructors)
+				 allow_zero_constructors=allow_zero_constructors,
+				 flat=flat,
+				 module=module)
 
 
 
@@ -27,10 +38,19 @@ def untyped_union(
 def union(
 		type_name: str, variant_specs: List[  Tuple[str, List[Tuple[str, type]] ]  ],
 		typecheck=True,
-		allow_zero_constructors=False ) -> List[Any]:
+		allow_zero_constructors=False,
+		flat=False,
+		module=None ) -> List[Any]:
 	"""
 	Analogous to the namedtuple function.
 
+	With flat=True, values are stored as one flat tuple instead of two nested ones
+	- see `_flat_union`.
+
+	Values can be pickled. The type is registered as `module.type_name`
+	(`module` defaults to the caller's module, like namedtuple's),
+	and a value is pickled as just that name, the variant id and the attribute values.
+
 
 	Creating a type:
 
@@ -78,6 +98,12 @@ def union(
 	if not allow_zero_constructors and len(variant_specs) == 0:
 		raise Exception("No variants specified for " + type_name)
 
+	if module is None:
+		module = _caller_module()
+
+	if flat:
+		return _flat_union(type_name, variant_specs, typecheck, module)
+
 
 	variant_names      = [variant_name for (variant_name, attr_names_and_types) in variant_specs]
 	variant_attr_specs = [attr_names_and_types for (variant_name, attr_names_and_types) in variant_specs]
@@ -175,10 +201,8 @@ def union(
 				val__ = BackingTuple(*args, **kwargs)
 
 			except TypeError as t_err:
-				# err_text = t_err.args[0]
-				# modified_err_text = _modified_constructor_err_text(type_name, variant_name, err_text)
-				# # ^ helper defined at end of file
-				raise t_err
+				raise _constructor_type_error(type_name, variant_name, t_err) from None
+				# ^ helper defined at end of file
 
 
 
@@ -313,12 +337,246 @@ def union(
 	# UserUnionType.__iter__ = lambda obj: obj.val__.__iter__() # can't do this - it breaks namedtuple's _asdict(), _replace(), _make(), and others
 	# use as_tuple and iter over that instead.
 
+	_register(UserUnionType, type_name, module, _layout(variant_specs, typecheck, flat=False))
+
 	return [UserUnionType] + variant_constructors
 
 
 
 
 
+# Flat representation
+
+def _flat_union(
+		type_name: str, variant_specs: List[  Tuple[str, List[Tuple[str, type]] ]  ],
+		typecheck: bool,
+		module: str ) -> List[Any]:
+	"""
+	`union(..., flat=True)`
+
+	A value of a flat union is a single tuple
+		(variant_id, attr_1, attr_2, ...)
+	instead of a namedtuple (id__, val__) wrapping the variant's VariantNameVal namedtuple,
+	so it takes one allocation instead of two. Attribute getters index straight into the tuple.
+
+	The API is the same (is_VariantName, as_tuple, as_dict, replace, get_variant_name...),
+	`id__` and `val__` are still there as properties.
+	The VariantNameVal namedtuples are still created, and used to check constructor arguments.
+	"""
+
+	variant_names      = [variant_name for (variant_name, attr_names_and_types) in variant_specs]
+	variant_attr_names = [[attr_name for (attr_name, attr_type) in attr_names_and_types]
+						  for (variant_name, attr_names_and_types) in variant_specs]
+	variant_ids = range(len(variant_names))
+
+	variant_backing_tuples = \
+		[typing.NamedTuple(variant_name+"Val", attr_names_and_types)
+		 for (variant_name, attr_names_and_types)
+		 in variant_specs ]
+
+
+	UserUnionType = type(type_name, (tuple,), {'__slots__': ()})
+
+	UserUnionType.id__  = property(itemgetter(0))
+	UserUnionType.val__ = property(lambda obj: variant_backing_tuples[obj[0]](*obj[1:]))
+
+
+	def __str__(x: UserUnionType) -> str:
+		this_variant_attr_names = variant_attr_names[x[0]]
+		attr_reprs = (name + '=' + repr(value)  for (name, value) in zip(this_variant_attr_names, x[1:]))
+		return variant_names[x[0]] + '(' + str.join(', ', attr_reprs) + ')'
+
+	UserUnionType.__str__ = __str__
+	UserUnionType.__repr__ = __str__
+
+
+	def make_is_variant_name(variant_id: int):
+		def is_variant_name(obj: UserUnionType) -> bool:
+			return obj[0] == variant_id
+		return is_variant_name
+
+	for (variant_id, variant_name) in zip(variant_ids, variant_names):
+		setattr(UserUnionType, ('is_' + variant_name), make_is_variant_name(variant_id))
+
+
+	def wrongly_typed_attr(val, attr_names: List[str]):
+		""" returns (attr_name, specified_attr_type, attr_val) for the first attr that has the wrong type """
+		specified_attr_types = val._field_types
+		for attr_name in attr_names:
+			attr_val = getattr(val, attr_name)
+			if type(attr_val) != specified_attr_types[attr_name]:
+				return (attr_name, specified_attr_types[attr_name], attr_val)
+		return None
+
+
+	# constructors
+
+	def make_constructor(variant_id: int, variant_name: str, BackingTuple: type):
+		def constructor(*args, **kwargs):
+			# the backing namedtuple checks the arguments (its messages are reworded like the nested ones)
+			try:
+				val = BackingTuple(*args, **kwargs)
+			except TypeError as t_err:
+				raise _constructor_type_error(type_name, variant_name, t_err) from None
+			o_wrong = wrongly_typed_attr(val, val._fields) if typecheck else None
+			if o_wrong is not None:
+				attr_name, specified_attr_type, attr_val = o_wrong
+				raise TypeError(type_name+".{variant_name} constructor: attribute {attr_name} has specified type {specified_attr_type}, but is {arg}: {arg_type}" \
+					             .format(variant_name=variant_name, attr_name=repr(attr_name),
+					             		 specified_attr_type=specified_attr_type,
+					             	     arg=repr(attr_val), arg_type=type(attr_val)))
+			return tuple.__new__(UserUnionType, (variant_id,) + tuple(val))
+
+		return constructor
+
+	variant_constructors = \
+		[make_constructor(variant_id, variant_name, BackingTuple)
+		 for (variant_id, variant_name, BackingTuple)
+		 in zip(variant_ids, variant_names, variant_backing_tuples) ]
+
+	for (variant_name, constructor) in zip(variant_names, variant_constructors):
+		setattr(UserUnionType, variant_name, constructor)
+
+	UserUnionType.variant_names = variant_names
+	UserUnionType.variant_constructors   = variant_constructors
+	UserUnionType.variant_backing_tuples = variant_backing_tuples
+
+
+	# attribute getters
+
+	all_attr_names = set( sum(variant_attr_names, []) )
+
+	for attr_name in all_attr_names:
+		# position of attr_name in each variant's tuple, None if the variant doesn't have it
+		indices = tuple( attr_names.index(attr_name) + 1 if attr_name in attr_names else None
+						 for attr_names in variant_attr_names )
+
+		if len(set(indices)) == 1:
+			# every variant has it in the same place - no need to look at the variant id
+			get_attr = itemgetter(indices[0])
+		else:
+			get_attr = _flat_attr_getter(type_name, variant_names, attr_name, indices)
+
+		setattr(UserUnionType, attr_name, property(get_attr))
+		setattr(UserUnionType, 'get_' + attr_name, get_attr)
+
+
+	# methods
+
+	UserUnionType.is_same_variant = lambda obj1, obj2: obj1[0] == obj2[0]
+	UserUnionType.get_variant_name = lambda obj: variant_names[obj[0]]
+
+	UserUnionType.as_tuple = lambda obj: obj[1:]
+	UserUnionType.get_values = UserUnionType.as_tuple
+
+	UserUnionType.as_dict = lambda obj: obj.val__._asdict()
+
+
+	def replace(obj: UserUnionType, **replacements) -> UserUnionType:
+		variant_name = variant_names[obj[0]]
+		try:
+			new_val = obj.val__._replace(**replacements)
+
+		except ValueError as val_err: # Reuse namedtuple's error messages, but change the text
+			raise ValueError(type_name+'.'+variant_name + '.replace: ' + val_err.args[0])
+
+		o_wrong = wrongly_typed_attr(new_val, replacements.keys()) if typecheck else None
+		if o_wrong is not None:
+			attr_name, specified_attr_type, attr_val = o_wrong
+			raise TypeError(type_name+'.'+variant_name+".replace: Cannot set attribute {attr_name} with specified type {specified_attr_type} to {arg}: {arg_type}" \
+				             .format(attr_name=repr(attr_name),
+				             		 specified_attr_type=specified_attr_type,
+				             	     arg=repr(attr_val), arg_type=type(attr_val)))
+
+		return tuple.__new__(UserUnionType, (obj[0],) + tuple(new_val))
+
+	UserUnionType.replace = replace
+
+	_register(UserUnionType, type_name, module, _layout(variant_specs, typecheck, flat=True))
+
+	return [UserUnionType] + variant_constructors
+
+
+
+def _flat_attr_getter(type_name: str, variant_names: List[str], attr_name: str, indices: Tuple[int, ...]) -> Fun:
+	""" Gets `attr_name` from a flat union value, whose position depends on the variant. """
+	def get_attr(obj):
+		try:
+			return obj[indices[obj[0]]]
+		except TypeError: # the index is None - this variant doesn't have `attr_name`
+			raise AttributeError("'{}.{}' object has no attribute '{}'" \
+								 .format(type_name, variant_names[obj[0]], attr_name)) from None
+	return get_attr
+
+
+
+
+
+# Pickling
+
+# qualified name ('module.TypeName') -> union type
+_registered_unions = {}  # type: Dict[str, type]
+# qualified name -> the layout it was registered with, see `_layout`
+_registered_layouts = {}  # type: Dict[str, tuple]
+
+
+def _caller_module() -> str:
+	# the module that called `union`/`untyped_union` (2 frames up from here)
+	try:
+		return sys._getframe(2).f_globals.get('__name__', '__main__')
+	except (AttributeError, ValueError):
+		return '__main__'
+
+
+def _layout(variant_specs: List[Tuple[str, List[Tuple[str, type]]]], typecheck: bool, flat: bool) -> tuple:
+	# everything a pickled value depends on
+	return (flat, typecheck, tuple( (variant_name, tuple(attr_specs)) for (variant_name, attr_specs) in variant_specs ))
+
+
+def _register(UserUnionType: type, type_name: str, module: str, layout: tuple) -> None:
+	"""
+	Raises ValueError if another union with the same qualified name is already
+	registered - pickled values would unpickle as the wrong type.
+	Redefining a union the same way (e.g. reloading its module) is fine.
+	"""
+	qualified_name = module + '.' + type_name
+	o_layout = _registered_layouts.get(qualified_name, None)
+	if o_layout is not None and o_layout != layout:
+		raise ValueError("A different union named {} already exists - use another name, or pass module=" \
+						 .format(qualified_name))
+	UserUnionType.__module__ = module
+	UserUnionType.__qualname__ = type_name
+	UserUnionType.qualified_name__ = qualified_name
+	UserUnionType.__reduce__ = lambda obj: (_unpickle_union_value, (qualified_name, obj.id__, obj.as_tuple()))
+	_registered_unions[qualified_name] = UserUnionType
+	_registered_layouts[qualified_name] = layout
+
+
+def get_registered_union(qualified_name: str) -> type:
+	"""
+	Finds a union type by its qualified name. If its module hasn't been imported
+	yet (e.g. in a fresh worker process), it's imported first.
+	"""
+	o_union = _registered_unions.get(qualified_name, None)
+	if o_union is not None:
+		return o_union
+
+	module_name, _, type_name = qualified_name.rpartition('.')
+	module = importlib.import_module(module_name)
+	o_union = _registered_unions.get(qualified_name, None)
+	if o_union is not None:
+		return o_union
+	# the module was imported under a different name, e.g. '__main__' as '__mp_main__'
+	return getattr(module, type_name)
+
+
+def _unpickle_union_value(qualified_name: str, variant_id: int, values: tuple):
+	UserUnionType = get_registered_union(qualified_name)
+	return UserUnionType.variant_constructors[variant_id](*values)
+
+
+
+
 def match(x, **variant_name_to_lamb):
 	cls = type(x)
 	for pat_name in variant_name_to_lamb.keys():
@@ -368,13 +626,13 @@ Example, \
 
 
 
-Example, \
+UntypedExample, \
 		Foo,\
 		Bar,\
 		BazBaz, \
 \
 = untyped_union(
-	'Example', [
+	'UntypedExample', [
 		 ('Foo',    ['r'     ]),
 		 ('Bar',    ['x', 'y']),
 		 ('BazBaz', [        ]),
@@ -386,6 +644,12 @@ Example, \
 # Helpers for modifying namedtuple error messages
 
 
+def _constructor_type_error(type_name: str, variant_name: str, t_err: TypeError) -> TypeError:
+	# newer pythons start the message with the backing tuple's name: 'FixedVal.__new__() missing ...'
+	err_text = re.sub(r'^\w+\.__new__\(\)', '__new__()', str(t_err))
+	return TypeError(_modified_constructor_err_text(type_name, variant_name, err_text))
+
+
 def _modified_constructor_err_text(type_name: str, variant_name: str, err_text: str) -> str:
 	# could probably be done way easier with regex
  	# '__new__() takes 2 positional arguments but 3 were given'
@@ -396,7 +660,7 @@ def _modified_constructor_err_text(type_name: str, variant_name: str, err_text:
 		modified_err_text = _modified_positional_args_err_text(type_name, variant_name, err_text) # defined at the end of the file
 
 	else:
-		modified_err_text = err_text.replace('__new__()', type_name + '.' + variant_name + ' constructor')
+		modified_err_text = err_text.replace('__new__() ', type_name + '.' + variant_name + ' constructor: ')
 
 	return modified_err_text
 